@@ -1,6 +1,7 @@
 # useful utilities for dealing with hysplit
 
-import glob, os, datetime, warnings
+import glob, os, datetime, time
+from contextlib import contextmanager
 import matplotlib as mpl
 # mpl.use('Agg')
 # import matplotlib.pyplot as plt
@@ -17,6 +18,23 @@ from subprocess import call
 # from sqlalchemy import create_engine
 # pg = create_engine('postgresql:///hysplit_xcite')
 
+# log10 concentration contour levels
+log_levels = list(range(-17, -10)) + [-5]
+
+# functions called with (stage, seconds) after each timed stage, so
+# the server can record how long contouring etc. take
+stage_observers = []
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        for observer in stage_observers:
+            observer(stage, seconds)
+
 def get_contours(p):
     """"Get contours from a contour plot"""
     contours = []
@@ -78,7 +96,9 @@ def contours2geojson(p, height, cmap='jet'):
 def matrix2geojsoncontours():
     pass
 
-def add_contours_to_db(pg, filename, sim_id, height, time):
+def add_contours_to_db(pg, filename, sim_id, height, time, progress=None):
+    # progress is the fraction of the simulation's contours that are
+    # done after adding this one
     with open(filename, 'r') as topofile:
         topo_str = topofile.read()
     if sim_id is None:
@@ -89,7 +109,14 @@ def add_contours_to_db(pg, filename, sim_id, height, time):
              ',' + str(height) + ',' + str(time) +
              ",'" + topo_str +
              "') on conflict (simulation_id,height,time) do update set topojson=excluded.topojson where contours.simulation_id=excluded.simulation_id and contours.height=excluded.height and contours.time=excluded.time")
-    with pg.connect() as con:
+    if progress is not None and sim_id is not None:
+        # update the progress in the same query
+        query = ('with contour as (' + query +
+                 ') update simulations set progress=' + str(progress) +
+                 ' where id=' + sim_str)
+    # sqlalchemy doesn't autocommit queries starting with 'with', so
+    # use an explicit transaction
+    with timed('db_insert'), pg.begin() as con:
         con.execute(query)
 
 def write_contour_files(pg, fwd, hysplit, site_folder, loglevels,
@@ -103,14 +130,17 @@ def write_contour_files(pg, fwd, hysplit, site_folder, loglevels,
     y = hysplit.coords['latitude'].values
     hylevels = hysplit.coords['levels'].values
     hytimes = hysplit.coords['time'].values
+    nframes = len(hylevels) * hysplit.dims['time']
     for i, h in enumerate(hysplit.coords['levels']):
         for j in range(hysplit.dims['time']):
             time_ind = j
             if not fwd:
                 time_ind = hysplit.dims['time'] - 1 - j
-            z = hysplit['log10PM'].isel(time=time_ind, levels=i)
-            p2 = ax.contourf(x, y, z, levels=np.array(loglevels))
-            gjson = make_json(p2, height=h)
+            # (only reads this slice if the data is lazy)
+            z = hysplit['log10PM'].isel(time=time_ind, levels=i).values
+            with timed('contouring'):
+                p2 = ax.contourf(x, y, z, levels=np.array(loglevels))
+                gjson = make_json(p2, height=h)
             # clear away old contours
             ax.collections = []
             fname = 'height' + str(i) + '_time' + str(j)
@@ -118,9 +148,12 @@ def write_contour_files(pg, fwd, hysplit, site_folder, loglevels,
             topofile = site_folder + fname + '.json'
             with open(geofile, 'w') as outfile:
                 geojson.dump(gjson, outfile)
-            call(['geo2topo', geofile, '-o', topofile, '-q', str(quantize)])
-            # now add the topojson to postgres
-            add_contours_to_db(pg, topofile, sim_id, i, j)
+            with timed('geo2topo'):
+                call(['geo2topo', geofile, '-o', topofile, '-q', str(quantize)])
+            # now add the topojson to postgres, where it can be
+            # viewed right away
+            progress = (i * hysplit.dims['time'] + j + 1) / nframes
+            add_contours_to_db(pg, topofile, sim_id, i, j, progress)
             # don't need to do this anymore because I'm deleting the entire folder afterwards:
             # # remove unnecessary files
             # call(['rm', geofile])
@@ -264,9 +297,10 @@ def get_trajectory(fwd, data_dir, control):
     tr_df = pd.read_fwf(trajectory_file, widths = col_widths, header=None, skiprows=5)
     return make_trajectory_feature(tr_df, control.times)
 
-def make_metajson(data_dir, fwd, hysplit, conc_control, traj_ens_control,
-                  traj1_control, site_folder, levels):
-        # organize the metadata json
+def make_trajectory_metajson(data_dir, fwd, conc_control, traj_ens_control,
+                             traj1_control, levels):
+    # organize the metadata that doesn't depend on the concentration
+    # output, so it can be made while the concentration model runs
     metadata = control_json(conc_control)
     # the contour times
     meta_times = npdt_to_str(conc_control.times)
@@ -274,7 +308,6 @@ def make_metajson(data_dir, fwd, hysplit, conc_control, traj_ens_control,
         metadata['times'] = meta_times
     else:
         metadata['times'] = list(reversed(meta_times))
-    metadata['heights'] = hysplit.coords['levels'].values.tolist()
     metadata['trajectories'] = get_ens_trajectories(fwd, data_dir, traj_ens_control)
     metadata['trajectory'] = get_trajectory(fwd, data_dir, traj1_control)
     # add lat/lon (needed for custom simulations)
@@ -283,6 +316,17 @@ def make_metajson(data_dir, fwd, hysplit, conc_control, traj_ens_control,
     metadata['levels'] = levels
     return metadata
 
+def make_metajson(data_dir, fwd, hysplit, conc_control, traj_ens_control,
+                  traj1_control, site_folder, levels, metadata=None):
+    # organize the metadata json, starting from the trajectory
+    # metadata if it's already been made
+    if metadata is None:
+        metadata = make_trajectory_metajson(data_dir, fwd, conc_control,
+                                            traj_ens_control,
+                                            traj1_control, levels)
+    metadata['heights'] = hysplit.coords['levels'].values.tolist()
+    return metadata
+
 def write_meta_file(data_dir, fwd, hysplit, conc_control,
                     traj_ens_control, traj1_control, site_folder):
     metadata = make_metajson(data_dir, fwd, hysplit,
@@ -292,16 +336,148 @@ def write_meta_file(data_dir, fwd, hysplit, conc_control,
     with open(meta_file, 'w') as outfile:
         json.dump(metadata, outfile)
 
-def add_metadata_to_db(pg, sim_id, metadata):
+def add_metadata_to_db(pg, sim_id, metadata, progress=None):
     # time_str = '{' + str(list(map(str, metadata['times'])))[1:-1] + '}'
     # height_str = '{' + str(metadata['heights'])[1:-1] + '}'
-    query = ("update simulations set metadata='" +
-             json.dumps(metadata) + "' where id=" + str(sim_id))
-    with pg.connect() as con:
+    query = "update simulations set metadata='" + json.dumps(metadata) + "'"
+    if progress is not None:
+        query += ', progress=' + str(progress)
+    query += ' where id=' + str(sim_id)
+    with timed('db_insert'), pg.connect() as con:
         con.execute(query)
 
+def write_trajectory_metadata(pg, fwd, controls, sim_id):
+    # add the partial (trajectory-only) metadata of a custom simulation
+    # to postgres, before the concentration output is available
+    tr1_control = TrajectoryControl(controls['single_trajectory'])
+    tr_ens_control = TrajectoryControl(controls['ens_trajectory'])
+    conc_control = ConcentrationControl(controls['concentration'])
+    metadata = make_trajectory_metajson('./', fwd, conc_control,
+                                        tr_ens_control, tr1_control,
+                                        log_levels)
+    add_metadata_to_db(pg, sim_id, metadata, progress=0)
+    return metadata
+
+def fortran_records(data):
+    """Iterate over the records of a big-endian Fortran unformatted file,
+    given as a uint8 array"""
+    pos = 0
+    while pos < len(data):
+        nbytes = int(data[pos:pos + 4].view('>i4')[0])
+        yield data[pos + 4:pos + 4 + nbytes]
+        # skip the record length markers at both ends
+        pos += nbytes + 8
+
+def cdump_time(values):
+    """Get a datetime from the (2-digit year) times in a cdump record"""
+    year, month, day, hour = values[:4]
+    return datetime.datetime(2000 + year % 100, month, day, hour)
+
+# packed concentrations: (i, j) grid indices and the concentration
+cdump_packed_dtype = np.dtype([('i', '>i2'), ('j', '>i2'), ('conc', '>f4')])
+
+def read_cdump(cdump_file):
+    """Read a HYSPLIT binary concentration (cdump) file into an xarray
+    dataset like the one produced by conc2cdf, without converting it
+    to netCDF first. The file is memory-mapped and parsed with numpy.
+
+    """
+    data = np.memmap(cdump_file, dtype=np.uint8, mode='r')
+    records = fortran_records(data)
+    # met model id, met start time, number of release locations and
+    # packing flag
+    header = next(records)[4:].view('>i4')
+    nlocations = header[5]
+    packed = header[6] == 1
+    # skip the release locations
+    for n in range(nlocations):
+        next(records)
+    # the concentration grid
+    rec = next(records)
+    nlat, nlon = rec[:8].view('>i4')
+    dlat, dlon, lat0, lon0 = rec[8:24].view('>f4')
+    latitudes = lat0 + dlat * np.arange(nlat)
+    longitudes = lon0 + dlon * np.arange(nlon)
+    levels = next(records)[4:].view('>i4').astype(int)
+    rec = next(records)
+    npollutants = int(rec[:4].view('>i4')[0])
+    pollutants = [ bytes(rec[4 + 4 * n:8 + 4 * n]).decode().strip()
+                   for n in range(npollutants) ]
+    # the concentrations for each sampling period
+    times = []
+    frames = []
+    for rec in records:
+        times.append(cdump_time(rec.view('>i4')))
+        # skip the sample stop time
+        next(records)
+        frame = np.zeros((npollutants, len(levels), nlat, nlon), dtype='f4')
+        for p in range(npollutants):
+            for k in range(len(levels)):
+                rec = next(records)
+                if packed:
+                    npoints = int(rec[8:12].view('>i4')[0])
+                    points = rec[12:12 + 8 * npoints].view(cdump_packed_dtype)
+                    frame[p, k, points['j'] - 1, points['i'] - 1] = points['conc']
+                else:
+                    frame[p, k] = rec[8:].view('>f4').reshape((nlat, nlon))
+        frames.append(frame)
+    conc = np.stack(frames)
+    dims = ('time', 'levels', 'latitude', 'longitude')
+    data_vars = { pollutant: (dims, conc[:, p])
+                  for p, pollutant in enumerate(pollutants) }
+    coords = {'time': np.array(times, dtype='datetime64[ns]'),
+              'levels': levels, 'latitude': latitudes,
+              'longitude': longitudes}
+    return xr.Dataset(data_vars, coords=coords)
+
+def log10_concentrations(pm):
+    """Take the log10 of the concentrations in place, one time step at a
+    time to avoid full-size temporary arrays. Zero concentrations
+    become -inf, and missing values stay NaN. Returns the log values
+    along with the minimum and maximum finite log values."""
+    values = pm.values
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype(float)
+    min_level = np.inf
+    max_level = -np.inf
+    # views of the array with time first
+    for v in np.moveaxis(values, pm.get_axis_num('time'), 0):
+        positive = v > 0
+        zero = v == 0
+        # like np.log10, negative values become NaN
+        with np.errstate(invalid='ignore'):
+            np.log10(v, out=v, where=~zero)
+        v[zero] = -np.inf
+        min_level = min(min_level, np.min(v, where=positive, initial=np.inf))
+        max_level = max(max_level, np.max(v, where=positive, initial=-np.inf))
+    return values, min_level, max_level
+
+def fill_log10_zeros(values, time_axis, fill_value):
+    """Replace -inf log values in place, one time step at a time"""
+    for v in np.moveaxis(values, time_axis, 0):
+        v[np.isneginf(v)] = fill_value
+
+def lazy_concentration_range(pm):
+    """Get the minimum and maximum log10 of the positive concentrations
+    in a dask-backed array, reading it one chunk at a time"""
+    import dask
+    positive = pm.where(pm > 0)
+    # computing both together means the file is only read once
+    min_pm, max_pm = dask.compute(positive.min(), positive.max())
+    return np.log10(min_pm.values), np.log10(max_pm.values)
+
+def lazy_log10_concentrations(pm, fill_value):
+    """Get the (lazy) log10 of the concentrations, with zero
+    concentrations set to fill_value and missing values left as NaN"""
+    return np.log10(pm.where(pm > 0)).where(pm != 0, fill_value)
+
 def write_json_files(pg, site, fwd, site_folder0, quantize, data_dir,
-                     controls=None, sim_id=None):
+                     controls=None, sim_id=None, chunked=False,
+                     metadata=None):
+    # if chunked is True, the concentrations are read lazily (with
+    # dask) one (level, time) slice at a time instead of all at once.
+    # metadata can be the trajectory metadata from
+    # write_trajectory_metadata, so the trajectories aren't read twice
     if fwd:
         fwd_str = 'fwd'
         tr1_id = '001'
@@ -330,9 +506,16 @@ def write_json_files(pg, site, fwd, site_folder0, quantize, data_dir,
         tr1_control = TrajectoryControl(controls['single_trajectory'])
         tr_ens_control = TrajectoryControl(controls['ens_trajectory'])
         conc_control = ConcentrationControl(controls['concentration'])
-        nc_file = 'cdump.nc'
+        nc_file = None
+    if nc_file is None:
+        # read the binary output directly
+        with timed('cdump_read'):
+            hysplit = read_cdump('cdump')
     # get hysplit data from netcdf
-    hysplit = xr.open_dataset(nc_file)
+    elif chunked:
+        hysplit = xr.open_dataset(nc_file, chunks={'time': 1, 'levels': 1})
+    else:
+        hysplit = xr.open_dataset(nc_file)
     # remove useless data
     if not conc_control.deposition:
         hysplit = hysplit.drop(0, 'levels')
@@ -343,34 +526,32 @@ def write_json_files(pg, site, fwd, site_folder0, quantize, data_dir,
     #     hysplit['PM'] = hysplit['TEST'] * 10**9
     if 'PM' not in list(hysplit.keys()):
         hysplit['PM'] = hysplit['TEST']
-    # get log values
-    with warnings.catch_warnings():
-        # don't want to see log of zero warnings
-        warnings.simplefilter("ignore")
-        hysplit['log10PM'] = np.log10(hysplit['PM'])
+    # get log values, along with their range, in a single pass
+    pm = hysplit['PM']
+    if chunked:
+        min_level, max_level = lazy_concentration_range(pm)
+    else:
+        log10pm, min_level, max_level = log10_concentrations(pm)
+        hysplit['log10PM'] = (pm.dims, log10pm)
 
     # what I should probably do: get the levels first, then replace
     # -inf with (min(levels) - 1) -- well I guess get the level
     # interval size first and do (min(levels) - dlevels)
-    min_level = hysplit['log10PM'].where(~np.isinf(hysplit['log10PM'])).min().values
-    max_level = hysplit['log10PM'].where(~np.isinf(hysplit['log10PM'])).max().values
     # now get nice tick intervals
-    zloc = MaxNLocator(nbins=8).tick_values(min_level, max_level)
+    zloc = MaxNLocator(nbins=8).tick_values(float(min_level), float(max_level))
     dz = zloc[1] - zloc[0]
     
-    hysplit['log10PM'].values = np.where(np.isinf(hysplit['log10PM']), zloc[0] - dz, hysplit['log10PM'])
+    if chunked:
+        hysplit['log10PM'] = lazy_log10_concentrations(pm, zloc[0] - dz)
+    else:
+        fill_log10_zeros(log10pm, pm.get_axis_num('time'), zloc[0] - dz)
     # contour levels
-    loglevels = list(range(-17, -10))
-    loglevels.append(-5)
+    loglevels = list(log_levels)
     # loglevels = zloc
     # loglevels = np.append(loglevels, zloc[-1] + 999) # top bin should get everything
     
-    # make the topojson files
-    # print('Starting contours...')
-    write_contour_files(pg, fwd, hysplit, site_folder, loglevels,
-                        quantize, sim_id)
-    
-    # get trajectories and write meta.json files
+    # get trajectories and write meta.json files -- the metadata goes
+    # in first so clients can show contour frames as they're added
     meta_times = npdt_to_str(hysplit.coords['time'])
     if fwd:
         n_str2 = '005'
@@ -380,12 +561,18 @@ def write_json_files(pg, site, fwd, site_folder0, quantize, data_dir,
     # write_meta_file(data_dir, fwd, hysplit, conc_control, tr_ens_control, tr1_control, site_folder)
     metadata = make_metajson(data_dir, fwd, hysplit,
                              conc_control, tr_ens_control,
-                             tr1_control, site_folder, loglevels)
+                             tr1_control, site_folder, loglevels,
+                             metadata)
     # meta_file = site_folder + 'meta.json'
     # with open(meta_file, 'w') as outfile:
     #     json.dump(metadata, outfile)
     # add it to postgres
-    add_metadata_to_db(pg, sim_id, metadata)
+    add_metadata_to_db(pg, sim_id, metadata, progress=0)
+    
+    # make the topojson files
+    # print('Starting contours...')
+    write_contour_files(pg, fwd, hysplit, site_folder, loglevels,
+                        quantize, sim_id)
     
     # close netcdf file
     hysplit.close()
@@ -1,7 +1,7 @@
 # different version -- this time the trajectories are all contained in a polyline
 # (needs a bit of work on the leaflet end)
 
-import json, geojson, sys
+import json, sys, struct
 import numpy as np
 import pandas as pd
 
@@ -24,45 +24,109 @@ def npdt_to_str(times):
     # round to nearest minute and write in ISO-8601 format
     return pd.to_datetime(times.astype(str)).round('1min').strftime('%Y-%m-%dT%H:%M:%SZ').tolist()
 
-def make_trajectory(x, y, z):
-    '''Create a list of (x,y,z) points for a single trajectory.'''
-    # check to make correct possible bug in starting times
-    check_val = x[1]
-    lx = len(x)
-    if np.isnan(check_val):
-        # find the last x None value
-        i = 0
-        while np.isnan(check_val) and i < lx - 1:
-            i += 1
-            if i == lx - 1:
-                return []
-            check_val = x[i + 1]
-        # swap values if it makes sense
-        if i < lx - 1:
-            x[[0, i]] = x[[i, 0]]
-            y[[0, i]] = y[[i, 0]]
-            z[[0, i]] = z[[i, 0]]
-    # Sometimes numpy uses non-standard float types that are rejected
-    # by the geojson package. Use astype(float) to ensure they are
-    # regular float-like.
-    return list(zip(x.astype(float), y.astype(float), z.astype(float)))
+def get_traj_array(da):
+    '''Get a (traj, time) float array from a trajectory DataArray.'''
+    other_dims = [ d for d in da.dims if d != 'traj' ]
+    # astype makes a copy, so the dataset isn't modified later
+    return da.transpose('traj', *other_dims).values.astype(float)
 
-def make_trajectories(ds):
+def fix_start_positions(x, y, z, *others):
+    '''Correct a possible bug in the trajectory starting times, for all
+    trajectories at once. If a trajectory's second point is missing,
+    the first point is moved to just before the first non-missing
+    point (along with the same point in any other arrays). Returns a
+    boolean array marking trajectories that have no points after the
+    first.
+
+    '''
+    missing = np.isnan(x)
+    late = missing[:, 1]
+    later_points = ~missing[:, 2:]
+    has_points = later_points.any(axis=1)
+    # swap the first point with the last missing point
+    rows = np.nonzero(late & has_points)[0]
+    if len(rows):
+        cols = later_points[rows].argmax(axis=1) + 1
+        for a in (x, y, z) + others:
+            a[rows, 0], a[rows, cols] = a[rows, cols], a[rows, 0]
+    return late & ~has_points
+
+def make_trajectory_index(x, y, empty, aod_dims):
+    '''Create an index of each trajectory's bounding box and the
+    offsets of its first and last points, so trajectories can be
+    filtered without reading every point.'''
+    valid = ~(np.isnan(x) | np.isnan(y))
+    xmin = np.where(valid, x, np.inf).min(axis=1)
+    xmax = np.where(valid, x, -np.inf).max(axis=1)
+    ymin = np.where(valid, y, np.inf).min(axis=1)
+    ymax = np.where(valid, y, -np.inf).max(axis=1)
+    first = valid.argmax(axis=1)
+    last = valid.shape[1] - 1 - valid[:, ::-1].argmax(axis=1)
+    bboxes = np.stack([xmin, ymin, xmax, ymax], axis=1).tolist()
+    offsets = np.stack([first, last], axis=1).tolist()
+    for i in np.nonzero(empty | ~valid.any(axis=1))[0]:
+        bboxes[i] = None
+        offsets[i] = None
+    # the server needs to know the aod array layout to slice it
+    return {'bbox': bboxes, 'offsets': offsets,
+            'aod_traj_first': aod_dims[0] == 'traj'}
+
+def make_trajectories_and_index(ds):
     '''Create a MultiLineString containing the trajectories in a netcdf
-    dataset.'''
+    dataset, along with the trajectory index.'''
     # fix times
     times = npdt_to_str(fix_times(ds['time'].values))
     
     # get all the lines
-    trajs = []
-    for i in range(ds.dims['traj']):
-        x = ds.coords['xtraj'].isel(traj=i).values
-        y = ds.coords['ytraj'].isel(traj=i).values
-        z = ds['ptraj'].isel(traj=i).values
-        trajs.append(make_trajectory(x, y, z))
-    mlstring = geojson.MultiLineString(trajs)
+    x = get_traj_array(ds.coords['xtraj'])
+    y = get_traj_array(ds.coords['ytraj'])
+    z = get_traj_array(ds['ptraj'])
+    empty = fix_start_positions(x, y, z)
+    # tolist gives regular python floats, which the json serializers
+    # need
+    trajs = np.stack([x, y, z], axis=-1).tolist()
+    for i in np.nonzero(empty)[0]:
+        trajs[i] = []
+    mlstring = {'type': 'MultiLineString', 'coordinates': trajs}
     properties = {'times': times, 'aod': ds['aod_traj'].values.tolist()}
-    return geojson.Feature(geometry=mlstring, properties=properties)
+    # a plain dict, since geojson.Feature would convert the geometry
+    # back to a geojson object and walk every coordinate
+    feature = {'type': 'Feature', 'geometry': mlstring,
+               'properties': properties}
+    index = make_trajectory_index(x, y, empty, ds['aod_traj'].dims)
+    return feature, index
+
+def make_trajectories(ds):
+    '''Create a MultiLineString containing the trajectories in a netcdf
+    dataset.'''
+    return make_trajectories_and_index(ds)[0]
+
+def make_linestring_ewkb(x, y, z, m, srid=4326):
+    '''Create a LineStringZM EWKB from coordinate arrays.'''
+    # little endian, LineString type with Z, M and SRID flags
+    header = struct.pack('<BIII', 1, 0xe0000002, srid, len(x))
+    return header + np.stack([x, y, z, m], axis=1).astype('<f8').tobytes()
+
+def make_trajectory_rows(ds):
+    '''Create a row for each trajectory in a netcdf dataset, with a
+    LineStringZM path (the M value is the time in seconds since
+    1970) and the AOD at each point. Missing points are left out, and
+    trajectories with fewer than 2 points are skipped.'''
+    times = fix_times(ds['time'].values)
+    m = (times - np.datetime64('1970-01-01')) / np.timedelta64(1, 's')
+    x = get_traj_array(ds.coords['xtraj'])
+    y = get_traj_array(ds.coords['ytraj'])
+    z = get_traj_array(ds['ptraj'])
+    aod = get_traj_array(ds['aod_traj'])
+    fix_start_positions(x, y, z, aod)
+    valid = ~(np.isnan(x) | np.isnan(y) | np.isnan(z))
+    rows = []
+    for n in np.nonzero(valid.sum(axis=1) >= 2)[0]:
+        v = valid[n]
+        path = make_linestring_ewkb(x[n, v], y[n, v], z[n, v], m[v])
+        rows.append({'traj': int(n), 'path': path,
+                     'aod': aod[n, v].tolist()})
+    return rows
 
 
 # 2) converting rasters (to postgresql)
@@ -80,6 +144,10 @@ def wkblify(fmt, data):
     fmt_little = '<' +fmt
     if isinstance(data, str):
         data = str.encode(data)
+    elif fmt[-1] in 'bBhHiI':
+        # nodata values from GDAL are always floats, even for integer
+        # bands
+        data = int(data)
     hexstr = binascii.hexlify(struct.pack(fmt_little, data)).upper()
 
     # String'ify raw value for log
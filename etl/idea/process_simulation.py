@@ -1,16 +1,16 @@
 # this script takes a set of simulation output netCDF files and
 # organizes it into database- and web-friendly data formats
 
-
-# I should consider storing raster data as half-precision (16bit)
-# floats to save space and for easier conversion to png
+# Raster data can be stored as scaled 16-bit integers to save space
+# (set scale_rasters below). The scale factors are saved to the
+# idea.band_scales table so the server can decode the values.
 
 # import matplotlib.pyplot as plt
-import json, datetime, simplejson, glob, re, warnings
+import json, datetime, simplejson, glob, re, warnings, io, struct, binascii
 import numpy as np
 import pandas as pd
 import xarray as xr
-from converter import make_trajectories, get_raster_binary
+from converter import make_trajectories_and_index, make_trajectory_rows, get_raster_binary
 import sqlalchemy
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy_utils.types.range import DateTimeRangeType
@@ -18,7 +18,7 @@ import psycopg2
 from psycopg2.extras import DateTimeRange, Json
 psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
 # for swaths and nwp
-from osgeo import gdal, osr
+from osgeo import gdal, ogr, osr
 gdal.UseExceptions()
 
 # set up postgres connection
@@ -31,6 +31,23 @@ pg = sqlalchemy.create_engine('postgresql:///lidar',
 m1 = sqlalchemy.schema.MetaData(pg, schema="idea")
 m1.reflect()
 
+# store NWP and swath rasters as scaled 16-bit integers
+scale_rasters = False
+# (scale_factor, add_offset) for each type of band -- values are
+# stored as round((value - add_offset) / scale_factor)
+band_scales = {'wind': (.01, 0),
+               'direction': (.1, 0),
+               'apcp': (.01, 0),
+               'aod': (.001, 0),
+               'cod': (.01, 0)}
+scaled_nodata = -32768
+# missing value for the wind direction and speed rasters
+wind_nodata = -9999
+# downsampling factors for the swath and NWP overview tables
+overview_factors = [2, 4, 8]
+# tolerance (in meters) for simplifying the swath footprints
+footprint_tolerance = 5000
+
 # traj_file = '/lulab/weiting/IDEA-I/IDEA-I_aerosol/products/CONUS/Aerosol/SNPP/20180401/VIIRSaerosolS_traj_48hr_20180401.nc'
 # grid_file = 'VIIRSaerosolEntHRS_grid_36hr_20180101.nc'
 
@@ -48,8 +65,8 @@ def get_new_traj_files(pg):
 
 def get_new_grid_files(pg):
     '''Find IDEA netCDF grid files to that haven't been added to the the
-    viirs.swaths or idea.nwp table.'''
-    q = "select distinct file, nc.high_resolution from idea_nc nc left join idea.nwp nwp on nwp.time::date=nc.date and nwp.high_resolution=nc.high_resolution left join viirs.swaths swt on swt.time::date=nc.date and swt.high_resolution=nc.high_resolution where nc.dataset='grid' and (nwp.id is null or swt.id is null)"
+    viirs.swaths, idea.nwp or idea.wind table.'''
+    q = "select distinct file, nc.high_resolution from idea_nc nc left join idea.nwp nwp on nwp.time::date=nc.date and nwp.high_resolution=nc.high_resolution left join viirs.swaths swt on swt.time::date=nc.date and swt.high_resolution=nc.high_resolution left join idea.wind wind on wind.time::date=nc.date and wind.high_resolution=nc.high_resolution where nc.dataset='grid' and (nwp.id is null or swt.id is null or wind.id is null)"
     # q = "select distinct file, nc.high_resolution from idea_nc nc where nc.dataset='grid' and high_resolution and date>='2018-08-28'"
     new_files = pd.read_sql(q, pg)
     # add the base of the filesystem
@@ -68,6 +85,156 @@ def get_date_from_nc_file(nc_file):
     date_str = re.sub(r'^.*_|\.nc$', '', nc_file)
     return datetime.datetime.strptime(date_str, '%Y%m%d')
 
+# postgres binary COPY format, see
+# https://www.postgresql.org/docs/current/sql-copy.html
+copy_header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+copy_trailer = struct.pack('!h', -1)
+pg_epoch = datetime.datetime(2000, 1, 1)
+
+def copy_binary_field(value):
+    '''Encode a timestamp, boolean or bytes value as a binary COPY
+    field'''
+    if isinstance(value, (bool, np.bool_)):
+        data = struct.pack('!?', value)
+    elif isinstance(value, datetime.datetime):
+        # microseconds since 2000-01-01
+        data = struct.pack('!q', (value - pg_epoch) // datetime.timedelta(microseconds=1))
+    else:
+        data = bytes(value)
+    return struct.pack('!i', len(data)) + data
+
+def make_copy_binary(rows):
+    '''Write rows to a file-like object in postgres' binary COPY
+    format'''
+    f = io.BytesIO()
+    f.write(copy_header)
+    for row in rows:
+        f.write(struct.pack('!h', len(row)))
+        for value in row:
+            f.write(copy_binary_field(value))
+    f.write(copy_trailer)
+    f.seek(0)
+    return f
+
+def get_raster_row(time, raster, hr):
+    '''Get a (time, raster WKB, high_resolution) row for the raster
+    tables'''
+    return (time, binascii.unhexlify(get_raster_binary(raster)), hr)
+
+def get_overview_table(table, factor):
+    '''Get the name of a raster table's overview table, named
+    o_<factor>_<table> like the raster2psql overviews'''
+    schema, name = table.split('.')
+    return '%s.o_%d_%s' % (schema, factor, name)
+
+def make_overview(raster, factor):
+    '''Downsample a raster by a factor, averaging the non-missing
+    pixels'''
+    return gdal.Translate('', raster, format='MEM',
+                          width=-(-raster.RasterXSize // factor),
+                          height=-(-raster.RasterYSize // factor),
+                          resampleAlg='average')
+
+def get_raster_levels(time, raster, hr):
+    '''Get rows for a raster and each of its overviews, as a dict keyed
+    by overview factor (1 for the full resolution raster)'''
+    levels = {1: get_raster_row(time, raster, hr)}
+    for factor in overview_factors:
+        overview = make_overview(raster, factor)
+        levels[factor] = get_raster_row(time, overview, hr)
+        overview = None
+    return levels
+
+def add_band_scales_to_pg(pg):
+    '''Save the scale factors for scaled integer bands to postgres'''
+    with pg.connect() as con:
+        for variable, (scale_factor, add_offset) in band_scales.items():
+            con.execute("insert into idea.band_scales (variable, scale_factor, add_offset) values (%s, %s, %s) on conflict (variable) do update set scale_factor=excluded.scale_factor, add_offset=excluded.add_offset",
+                        (variable, scale_factor, add_offset))
+
+def scale_array(a, nodata, scale_factor, add_offset):
+    '''Convert an array to scaled 16-bit integers'''
+    a = np.asarray(a, dtype=float)
+    missing = np.isnan(a)
+    if nodata is not None:
+        missing |= a == nodata
+    scaled = np.round((a - add_offset) / scale_factor)
+    scaled = np.clip(scaled, -32767, 32767)
+    scaled[missing] = scaled_nodata
+    return scaled.astype(np.int16)
+
+def make_mem_raster(like):
+    '''Create an empty in-memory raster with the same size and
+    georeferencing as another raster'''
+    r = gdal.GetDriverByName('MEM').Create('', like.RasterXSize,
+                                           like.RasterYSize, 0)
+    r.SetGeoTransform(like.GetGeoTransform())
+    r.SetProjection(like.GetProjection())
+    return r
+
+def add_band(r, a, datatype, nodata, variable):
+    '''Add an array to a raster as a new band, converting it to scaled
+    16-bit integers if scale_rasters is set'''
+    if scale_rasters:
+        scale_factor, add_offset = band_scales[variable]
+        a = scale_array(a, nodata, scale_factor, add_offset)
+        datatype = gdal.GDT_Int16
+        nodata = scaled_nodata
+    r.AddBand(datatype)
+    band = r.GetRasterBand(r.RasterCount)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    band.WriteArray(a)
+
+def copy_rasters_to_pg(cur, table, column, rows):
+    '''Add (time, raster WKB, high_resolution) rows to a raster table,
+    staging them in a temporary table with a binary COPY'''
+    # the raster type has no binary input function, so stage the
+    # rasters as bytea and convert them when merging
+    staging = table.replace('.', '_') + '_staging'
+    cur.execute("create temp table %s (time timestamp, wkb bytea, high_resolution boolean) on commit drop" %
+                staging)
+    cur.copy_expert("copy %s from stdin with (format binary)" % staging,
+                    make_copy_binary(rows))
+    cur.execute("insert into %s (time, %s, high_resolution) select distinct on (time, high_resolution) time, encode(wkb, 'hex')::raster, high_resolution from %s on conflict (time, high_resolution) do update set %s=excluded.%s" %
+                (table, column, staging, column, column))
+
+def copy_raster_levels_to_pg(cur, table, column, level_rows):
+    '''Add rasters to a raster table and its overview tables, from
+    dicts of rows keyed by overview factor'''
+    copy_rasters_to_pg(cur, table, column, [ r[1] for r in level_rows ])
+    for factor in overview_factors:
+        copy_rasters_to_pg(cur, get_overview_table(table, factor), column,
+                           [ r[factor] for r in level_rows ])
+
+def copy_swath_footprints_to_pg(cur, rows):
+    '''Add (time, envelope WKB, footprint WKB, high_resolution)
+    footprints to the swaths'''
+    cur.execute("create temp table footprint_staging (time timestamp, envelope bytea, footprint bytea, high_resolution boolean) on commit drop")
+    cur.copy_expert("copy footprint_staging from stdin with (format binary)",
+                    make_copy_binary(rows))
+    cur.execute("update viirs.swaths s set envelope=ST_GeomFromWKB(f.envelope, 3857), footprint=ST_GeomFromWKB(f.footprint, 3857) from footprint_staging f where s.time=f.time and s.high_resolution=f.high_resolution")
+
+def add_grid_rasters_to_pg(conn, swath_rows, swath_footprints, nwp_rows,
+                           wind_rows):
+    '''Add a grid file's swaths, NWP and wind rasters to postgres in a
+    single transaction, so a partially loaded day is never visible'''
+    # the connection is normally in autocommit mode for the raster
+    # commands, turn it off just for this transaction
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            copy_raster_levels_to_pg(cur, 'viirs.swaths', 'swath', swath_rows)
+            copy_swath_footprints_to_pg(cur, swath_footprints)
+            copy_raster_levels_to_pg(cur, 'idea.nwp', 'nwp', nwp_rows)
+            copy_rasters_to_pg(cur, 'idea.wind', 'wind', wind_rows)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
+
 
 
 # Trajectories
@@ -75,7 +242,8 @@ def get_date_from_nc_file(nc_file):
 def add_trajectories_to_pg(pg, traj_file, high_resolution):
     # make trajectory geojson
     traj_ds = xr.open_dataset(traj_file)
-    traj_gj = make_trajectories(traj_ds)
+    traj_gj, traj_index = make_trajectories_and_index(traj_ds)
+    traj_rows = make_trajectory_rows(traj_ds)
     # get simulation time range
     start_time = npdt_to_dt(traj_ds.coords['time'].values[0])
     end_time = npdt_to_dt(traj_ds.coords['time'].values[-1])
@@ -83,14 +251,24 @@ def add_trajectories_to_pg(pg, traj_file, high_resolution):
     # add to postgres
     simulation = {'time_range': sim_time_range,
                   'trajectories': traj_gj,
+                  'trajectory_index': traj_index,
                   'high_resolution': high_resolution}
-    ins1 = insert(m1.tables['idea.simulations'])
+    sims = m1.tables['idea.simulations']
+    ins1 = insert(sims)
     ins1 = ins1.on_conflict_do_update(
         index_elements=['time_range', 'high_resolution'],
-        set_=dict(ins1.excluded)
-    )
-    with pg.connect() as con:
-        con.execute(ins1, simulation)
+        # keep the old id, which idea.trajectories refers to
+        set_={ c.name: c for c in ins1.excluded if c.name != 'id' }
+    ).returning(sims.c.id)
+    # also store the trajectories one per row, replacing any old ones
+    trajs = m1.tables['idea.trajectories']
+    with pg.begin() as con:
+        sim_id = con.execute(ins1, simulation).scalar()
+        con.execute(trajs.delete().where(trajs.c.simulation_id == sim_id))
+        for row in traj_rows:
+            row['simulation_id'] = sim_id
+        if traj_rows:
+            con.execute(trajs.insert(), traj_rows)
 
 
 
@@ -120,39 +298,91 @@ def get_swath_ds(nc_file, swath_id):
     cod_str = 'NETCDF:"%s":cld_opd_dcomp_%03d' % (nc_file, swath_id)
     aod = gdal.Warp('', aod_str, geoloc=True, format='MEM', dstSRS='EPSG:3857')
     cod = gdal.Warp('', cod_str, geoloc=True, format='MEM', dstSRS='EPSG:3857')
-    aod.AddBand(aod.GetRasterBand(1).DataType)
-    aod.GetRasterBand(2).SetNoDataValue(-999)
-    aod.GetRasterBand(2).WriteArray(cod.GetRasterBand(1).ReadAsArray())
-    return aod
-
-def _add_swath_to_pg(conn, swath, swath_time, hr):
-    '''Add a VIIRS swath to postgres'''
-    cur = conn.cursor()
-    cur.execute("insert into viirs.swaths (time, swath, high_resolution) values (%s, %s::raster, %s) on conflict(time, high_resolution) do update set swath=excluded.swath",
-                (swath_time, get_raster_binary(swath), hr))
-    cur.close()
-
-def add_swath_to_pg(conn, nc_file, swath_id, hr):
-    '''Add a VIIRS swath to postgres'''
+    swath = make_mem_raster(aod)
+    # keep the swath time metadata
+    swath.SetMetadata(aod.GetMetadata())
+    aod_band = aod.GetRasterBand(1)
+    add_band(swath, aod_band.ReadAsArray(), aod_band.DataType,
+             aod_band.GetNoDataValue(), 'aod')
+    add_band(swath, cod.GetRasterBand(1).ReadAsArray(), aod_band.DataType,
+             -999, 'cod')
+    return swath
+
+def get_swath_envelope(swath):
+    '''Get the bounding box of a swath as an OGR polygon'''
+    gt = swath.GetGeoTransform()
+    xs = sorted([gt[0], gt[0] + gt[1] * swath.RasterXSize])
+    ys = sorted([gt[3], gt[3] + gt[5] * swath.RasterYSize])
+    # same vertex order as ST_Envelope
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in [(xs[0], ys[0]), (xs[0], ys[1]), (xs[1], ys[1]),
+                 (xs[1], ys[0]), (xs[0], ys[0])]:
+        ring.AddPoint_2D(x, y)
+    envelope = ogr.Geometry(ogr.wkbPolygon)
+    envelope.AddGeometry(ring)
+    return envelope
+
+def get_swath_footprint(swath):
+    '''Get a simplified OGR multipolygon around a swath's non-missing
+    pixels'''
+    # the 8x overview is plenty detailed for a simplified outline
+    overview = make_overview(swath, overview_factors[-1])
+    valid = np.zeros((overview.RasterYSize, overview.RasterXSize), dtype=bool)
+    for i in range(1, overview.RasterCount + 1):
+        band = overview.GetRasterBand(i)
+        a = band.ReadAsArray()
+        band_valid = ~np.isnan(a) if a.dtype.kind == 'f' else np.ones(a.shape, dtype=bool)
+        if band.GetNoDataValue() is not None:
+            band_valid &= a != band.GetNoDataValue()
+        valid |= band_valid
+    mask = make_mem_raster(overview)
+    mask.AddBand(gdal.GDT_Byte)
+    mask_band = mask.GetRasterBand(1)
+    mask_band.WriteArray(valid.astype(np.uint8))
+    # polygonize the valid pixels (using the band as its own mask skips
+    # the missing pixels)
+    ogr_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = ogr_ds.CreateLayer('footprint', geom_type=ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('valid', ogr.OFTInteger))
+    gdal.Polygonize(mask_band, mask_band, layer, 0)
+    polygons = ogr.Geometry(ogr.wkbMultiPolygon)
+    for feature in layer:
+        polygons.AddGeometry(feature.GetGeometryRef())
+    if polygons.GetGeometryCount() == 0:
+        return polygons
+    footprint = polygons.UnionCascaded().SimplifyPreserveTopology(footprint_tolerance)
+    return ogr.ForceToMultiPolygon(footprint)
+
+def get_swath_row(nc_file, swath_id, hr):
+    '''Get a VIIRS swath as rows for the viirs.swaths table and its
+    overview tables, and the swath footprint'''
     swath = get_swath_ds(nc_file, swath_id)
     swath_time = get_date_from_nc_file(nc_file) + get_swath_time(swath, swath_id)
-    _add_swath_to_pg(conn, swath, swath_time, hr)
+    row = get_raster_levels(swath_time, swath, hr)
+    footprint = (swath_time, get_swath_envelope(swath).ExportToWkb(),
+                 get_swath_footprint(swath).ExportToWkb(), hr)
     # close the dataset
     swath = None
-    return swath_time
+    return row, footprint
 
-def process_swaths(conn, nc_file, hr):
-    '''Add netCDF swaths to postgres'''
+def process_swaths(nc_file, hr):
+    '''Get the netCDF swaths as rows for the viirs.swaths table and its
+    overview tables, and the swath footprints'''
     gdal_str = 'NETCDF:"%s"' % nc_file
     ds = gdal.Open(gdal_str)
     swath_count = get_swath_count(ds)
+    rows = []
+    footprints = []
     for swath_id in range(1, swath_count + 1):
         try:
-            add_swath_to_pg(conn, nc_file, swath_id, hr)
+            row, footprint = get_swath_row(nc_file, swath_id, hr)
+            rows.append(row)
+            footprints.append(footprint)
         except:
             warnings.warn('NetCDF file reported %s swaths, but swath %s failed.' %
                           (swath_count, swath_id))
     ds = None
+    return rows, footprints
 
 
 
@@ -193,41 +423,88 @@ def get_rasters_from_nc(nc_file, hr):
         rasters = list(map(open_nwp_raster, gdal_strs))
     return rasters
 
-def get_nwp(rasters, band, hr):
-    '''Reorganize rasters into a combined raster'''
+def read_nwp_arrays(rasters):
+    '''Read each NWP variable into a (time, y, x) array, using a single
+    GDAL read per variable'''
+    arrays = []
+    for raster in rasters:
+        a = raster.ReadAsArray()
+        # single-band rasters come back as 2D arrays
+        shape = (raster.RasterCount, raster.RasterYSize, raster.RasterXSize)
+        arrays.append(a.reshape(shape))
+    return arrays
+
+def get_hourly_apcp(apcp, nodata, hr):
+    '''Get the precipitation array for each NWP time from the
+    accumulated precipitation array. The precipitation for time n
+    comes from the accumulation at time n + 1, so the returned array
+    has one less time than the input.
+
+    '''
+    if not hr:
+        return apcp[1:]
+    # be careful with missing values
+    apcp = apcp.astype(float)
+    apcp[apcp == nodata] = np.nan
+    # subtract to find hourly precipitation, except where the
+    # accumulation starts over (every 3 hours)
+    restarts = np.arange(apcp.shape[0] - 1) % 3 == 0
+    hourly = np.where(restarts[:, None, None], apcp[1:], np.diff(apcp, axis=0))
+    hourly[np.isnan(hourly)] = nodata
+    return hourly
+
+def get_nwp(rasters, arrays, hourly_apcp, n):
+    '''Combine the NWP arrays for time index n into a multiband raster'''
     # create the new raster
-    nwp = gdal.Translate('', rasters[0], format='MEM', bandList=[1])
-    # add the rest of the wind rasters
-    if hr:
-        nrasters = 3
-    else:
-        nrasters = 7
-    for i, raster in enumerate(rasters[1:(nrasters - 1)]):
-        nwp.AddBand(raster.GetRasterBand(band).DataType)
-        nodata = raster.GetRasterBand(band).GetNoDataValue()
-        nwp.GetRasterBand(i + 2).SetNoDataValue(nodata)
-        nwp.GetRasterBand(i + 2).WriteArray(raster.GetRasterBand(band).ReadAsArray())
-    # add the rain raster
-    apcp = rasters[nrasters - 1]
-    if apcp.RasterCount > band:
-        nwp.AddBand(apcp.GetRasterBand(band + 1).DataType)
-        nodata = apcp.GetRasterBand(band + 1).GetNoDataValue()
-        nwp.GetRasterBand(nrasters).SetNoDataValue(nodata)
-        if hr and band % 3 != 1:
-            # subtract to find hourly precipitation
-            apcp1 = apcp.GetRasterBand(band).ReadAsArray()
-            apcp2 = apcp.GetRasterBand(band + 1).ReadAsArray()
-            # be careful with missing values
-            apcp1[apcp1 == nodata] = np.nan
-            apcp2[apcp2 == nodata] = np.nan
-            apcp_diff = apcp2 - apcp1
-            apcp_diff[np.isnan(apcp_diff)] = nodata
-            nwp.GetRasterBand(nrasters).WriteArray(apcp_diff)
-        else:
-            apcp1 = apcp.GetRasterBand(band + 1).ReadAsArray()
-            nwp.GetRasterBand(nrasters).WriteArray(apcp1)
+    nwp = make_mem_raster(rasters[0])
+    # add the wind rasters (every band is from time n -- the first band
+    # used to be copied from the first time step for every time)
+    bands = [ (a[n], 'wind') for a in arrays[:-1] ]
+    # add the rain raster, if the next accumulation is available
+    if n < len(hourly_apcp):
+        bands.append((hourly_apcp[n], 'apcp'))
+    for i, (band, variable) in enumerate(bands):
+        src_band = rasters[i].GetRasterBand(1)
+        add_band(nwp, band, src_band.DataType, src_band.GetNoDataValue(),
+                 variable)
     return nwp
 
+def get_wind_arrays(rasters, arrays):
+    '''Get the wind direction and speed (time, y, x) arrays for each
+    level from the horizontal wind components. Directions are in
+    degrees clockwise from due south, as required by the leaflet
+    geotiff add-on.'''
+    nlevels = (len(arrays) - 1) // 2
+    directions = []
+    speeds = []
+    for i in range(nlevels):
+        u = arrays[i].astype(np.float32)
+        v = arrays[i + nlevels].astype(np.float32)
+        missing = np.isnan(u) | np.isnan(v)
+        for r, a in [(rasters[i], u), (rasters[i + nlevels], v)]:
+            nodata = r.GetRasterBand(1).GetNoDataValue()
+            if nodata is not None:
+                missing |= a == nodata
+        direction = np.degrees(np.arctan2(-u, -v)) % 360
+        speed = np.hypot(u, v)
+        direction[missing] = wind_nodata
+        speed[missing] = wind_nodata
+        directions.append(direction)
+        speeds.append(speed)
+    return directions, speeds
+
+def get_wind(rasters, directions, speeds, n):
+    '''Combine the wind directions and speeds for time index n into a
+    multiband raster, with the directions for each level followed by
+    the speeds'''
+    wind = make_mem_raster(rasters[0])
+    for direction in directions:
+        add_band(wind, direction[n], gdal.GDT_Float32, wind_nodata,
+                 'direction')
+    for speed in speeds:
+        add_band(wind, speed[n], gdal.GDT_Float32, wind_nodata, 'wind')
+    return wind
+
 def get_times_from_raster(ds):
     '''Get the times from a GDAL raster.'''
     meta = ds.GetMetadata()
@@ -247,27 +524,37 @@ def get_times_from_raster(ds):
 #     # any subdataset with the time dimension
 #     return times
 
-def add_nwp_to_pg(pg, time, nwp, hr):
-    '''Add gridded NWP output to postgres'''
+def process_nwp(nc_file, hr):
+    '''Get the gridded NWP output as rows for the idea.nwp and idea.wind
+    tables'''
     # --- need to add some method for handling missing precipitation
     # --- data
     # No not true!-- just store precipitation as usual. The newer
     # filled-in data will replace the old missing data
-    with pg.cursor() as cur:
-        cur.execute("insert into idea.nwp (time, nwp, high_resolution) values (%s, %s::raster, %s) on conflict (time, high_resolution) do update set nwp = excluded.nwp",
-                    (npdt_to_dt(time), get_raster_binary(nwp), hr))
-
-def process_nwp(pg, nc_file, hr):
     # 1) get the rasters
     rasters = get_rasters_from_nc(nc_file, hr)
     times = get_times_from_raster(rasters[0])
     nbands = rasters[0].RasterCount
-    # 2) add combined rasters to postgres
+    # 2) read each variable once and get the hourly precipitation
+    arrays = read_nwp_arrays(rasters)
+    apcp_nodata = rasters[-1].GetRasterBand(1).GetNoDataValue()
+    hourly_apcp = get_hourly_apcp(arrays[-1], apcp_nodata, hr)
+    # and the wind directions and speeds, so the server doesn't have
+    # to calculate them
+    directions, speeds = get_wind_arrays(rasters, arrays)
+    # 3) get the combined rasters
+    nwp_rows = []
+    wind_rows = []
     for n in range(nbands):
-        nwp = get_nwp(rasters, n + 1, hr)
-        add_nwp_to_pg(pg, times[n], nwp, hr)
-        # close the dataset
+        time = npdt_to_dt(times[n])
+        nwp = get_nwp(rasters, arrays, hourly_apcp, n)
+        nwp_rows.append(get_raster_levels(time, nwp, hr))
+        wind = get_wind(rasters, directions, speeds, n)
+        wind_rows.append(get_raster_row(time, wind, hr))
+        # close the datasets
         nwp = None
+        wind = None
+    return nwp_rows, wind_rows
 
 
 
@@ -289,6 +576,8 @@ for index, row in traj_files.iterrows():
 print('Starting swaths and NWP output...')
 # grid_files = get_nc_files()
 grid_files = get_new_grid_files(pg)
+if scale_rasters:
+    add_band_scales_to_pg(pg)
 with psycopg2.connect("dbname=lidar user=will") as conn: 
     # autocommit MUST be set to true for the postgres raster commands to work
     conn.autocommit = True
@@ -297,5 +586,7 @@ with psycopg2.connect("dbname=lidar user=will") as conn:
         grid_file = row['file']
         hr = row['high_resolution']
         print('Starting file for %s' % get_date_from_nc_file(grid_file))
-        process_swaths(conn, grid_file, hr)
-        process_nwp(conn, grid_file, hr)
+        swath_rows, swath_footprints = process_swaths(grid_file, hr)
+        nwp_rows, wind_rows = process_nwp(grid_file, hr)
+        add_grid_rasters_to_pg(conn, swath_rows, swath_footprints, nwp_rows,
+                               wind_rows)
@@ -3,7 +3,7 @@
 # run from terminal with:
 # export FLASK_APP=server.py
 # python3 -m flask run --host=0.0.0.0 --with-threads -p 5679
-from flask import Flask, request, make_response
+from flask import Flask, request, make_response, send_file
 from flask_cors import CORS, cross_origin
 app = Flask(__name__)
 outside_sites = ['http://pireds.asrc.cestm.albany.edu',
@@ -12,34 +12,355 @@ outside_sites = ['http://pireds.asrc.cestm.albany.edu',
                  'nysmesonet.org', 'www.nysmesonet.org',
                  'xwww.nysmesonet.org']
 cors = CORS(app, resources={r"/*": {'origins': outside_sites}})
+import server_metrics
+from server_metrics import timed
+server_metrics.init_app(app)
 
-import datetime, time
+import datetime, json, io, os, uuid, hashlib
+from concurrent.futures import Future, ProcessPoolExecutor
+from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from matplotlib.figure import Figure
+import numpy as np
 import pandas as pd
 import xarray as xr
-# from sqlalchemy import create_engine
-# pg = create_engine('postgresql:///hysplit_xcite')
-cmaq_ds = xr.open_dataset('.nc')
+from scipy.spatial import cKDTree
+from sqlalchemy import create_engine
+# for the NYS Mesonet sites
+pg = create_engine('postgresql:///hysplit_xcite')
+
+# CMAQ output (IOAPI netCDF) and the matching GRIDCRO2D file with the
+# grid cell latitudes and longitudes
+cmaq_file = '/home/xcite/cmaq/CCTM_ACONC.nc'
+grid_file = '/home/xcite/cmaq/GRIDCRO2D.nc'
+# IOAPI dimensions of the species variables
+cmaq_dims = ('TSTEP', 'LAY', 'ROW', 'COL')
+# rendered profile plots are saved here
+plot_cache_dir = '/home/xcite/cmaq/plots/'
+# number of processes for rendering plots
+nrenderers = 4
+
+
+def ioapi_timedelta(hhmmss):
+    """Convert an IOAPI HHMMSS integer to a timedelta"""
+    return datetime.timedelta(hours=hhmmss // 10000,
+                              minutes=hhmmss // 100 % 100,
+                              seconds=hhmmss % 100)
+
+def get_cmaq_times(ds):
+    """Get the time of each CMAQ time step from the IOAPI attributes"""
+    start = datetime.datetime.strptime('%07d' % ds.attrs['SDATE'], '%Y%j')
+    start += ioapi_timedelta(ds.attrs['STIME'])
+    step = np.timedelta64(ioapi_timedelta(ds.attrs['TSTEP']))
+    return np.datetime64(start) + step * np.arange(ds.dims['TSTEP'])
+
+def lat_lon_to_xyz(lat, lon):
+    """Convert latitude and longitude to points on the unit sphere, so
+    distances in the KD-tree work everywhere on the grid"""
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.stack([np.cos(lat) * np.cos(lon),
+                     np.cos(lat) * np.sin(lon),
+                     np.sin(lat)], axis=-1)
+
+class CmaqIndex:
+    """Finds the CMAQ grid cells and time steps for requested latitudes,
+    longitudes and times"""
+    def __init__(self, ds, grid):
+        self.latitude = grid['LAT'].squeeze().values
+        self.longitude = grid['LON'].squeeze().values
+        self.shape = self.latitude.shape
+        self.tree = cKDTree(lat_lon_to_xyz(self.latitude.ravel(),
+                                           self.longitude.ravel()))
+        self.times = get_cmaq_times(ds)
+
+    def get_cells(self, lat, lon):
+        """Get the (row, col) indices of the nearest grid cells"""
+        dist, i = self.tree.query(lat_lon_to_xyz(lat, lon))
+        return np.unravel_index(i, self.shape)
+
+    def get_time_range(self, start_time, end_time):
+        """Get the slice of time steps from start_time to end_time
+        (inclusive)"""
+        i0 = np.searchsorted(self.times, np.datetime64(start_time), 'left')
+        i1 = np.searchsorted(self.times, np.datetime64(end_time), 'right')
+        if i0 >= i1:
+            raise KeyError('No CMAQ output from ' + str(start_time) +
+                           ' to ' + str(end_time))
+        return slice(int(i0), int(i1))
+
+    def get_time_index(self, time):
+        """Get the index of a time step, or raise a KeyError if there's
+        no output for the time"""
+        i = np.searchsorted(self.times, np.datetime64(time))
+        if i == len(self.times) or self.times[i] != np.datetime64(time):
+            raise KeyError('No CMAQ output for ' + str(time))
+        return int(i)
+
+# Open the files lazily: only the metadata and the grid coordinates are
+# read here, and the species data is read from disk as it's indexed
+cmaq_ds = xr.open_dataset(cmaq_file)
+with xr.open_dataset(grid_file) as grid_ds:
+    cmaq_index = CmaqIndex(cmaq_ds, grid_ds)
+cmaq_species = [ v for v in cmaq_ds.data_vars if cmaq_ds[v].dims == cmaq_dims ]
+
+def get_layer_levels():
+    """Get the sigma level at the middle of each CMAQ layer"""
+    vglvls = np.asarray(cmaq_ds.attrs['VGLVLS'])
+    return (vglvls[:-1] + vglvls[1:]) / 2
+
+def parse_time(time_str):
+    """Get a timezone-naive UTC datetime from a url argument"""
+    time = pd.to_datetime(time_str)
+    if time.tzinfo is not None:
+        time = time.tz_convert('UTC').tz_localize(None)
+    return time.to_pydatetime()
+
+def get_profiles(species, row, col, time_index):
+    """Read the vertical profiles of one grid column"""
+    with timed('cmaq_read'):
+        return { s: cmaq_ds[s].isel(TSTEP=time_index, ROW=row, COL=col).values.tolist()
+                 for s in species }
+
+def get_batch_profiles(species, rows, cols, times):
+    """Read the vertical profiles of many grid columns over a range of
+    times, with one vectorized read per species. Arrays have dimensions
+    (time, level, point)."""
+    rows = xr.DataArray(rows, dims='point')
+    cols = xr.DataArray(cols, dims='point')
+    with timed('cmaq_read'):
+        return { s: cmaq_ds[s].isel(TSTEP=times, ROW=rows, COL=cols).values
+                 for s in species }
+
+def get_sites():
+    """Get the NYS Mesonet site locations"""
+    q = 'select stid, latitude, longitude from sites order by stid'
+    with timed('db_query'):
+        return pd.read_sql(q, pg)
+
+# Profile plots
+
+plot_styles = ['linear', 'log']
+plot_formats = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+def render_profile_plot(profiles, levels, title, style, fmt):
+    """Render a profile plot with the Agg backend. Runs in the renderer
+    processes."""
+    fig = Figure(figsize=(4, 6))
+    FigureCanvas(fig)
+    ax = fig.add_subplot(111)
+    for species, profile in profiles.items():
+        ax.plot(profile, levels, label=species)
+    if style == 'log':
+        ax.set_xscale('log')
+    # sigma decreases with height
+    ax.invert_yaxis()
+    ax.set_xlabel('Concentration')
+    ax.set_ylabel('Sigma level')
+    ax.set_title(title)
+    ax.legend()
+    f = io.BytesIO()
+    fig.savefig(f, format=fmt, bbox_inches='tight')
+    return f.getvalue()
+
+def get_species_key(species):
+    """Get a short name for a set of species, to keep the plot file
+    names under the file name length limit"""
+    species = sorted(set(species))
+    if species == sorted(cmaq_species):
+        return 'all'
+    key = '-'.join(species)
+    if len(key) > 64:
+        key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return key
+
+def get_plot_file(location, time, species, style, fmt):
+    """Get the cache file name for a plot. The cache is separated by
+    CMAQ file version, so a new run doesn't use old plots."""
+    name = '_'.join([location, time.strftime('%Y%m%dT%H%M'),
+                     get_species_key(species), style])
+    return os.path.join(plot_cache_dir, cmaq_version, name + '.' + fmt)
+
+def save_plot(future, plot_file):
+    """Save a rendered plot to the cache"""
+    os.makedirs(os.path.dirname(plot_file), exist_ok=True)
+    # write to a temporary file first so nobody reads half a plot
+    # (unique, since two requests can render the same plot at once)
+    tmp_file = plot_file + '.tmp' + uuid.uuid4().hex
+    with open(tmp_file, 'wb') as f:
+        f.write(future.result())
+    os.replace(tmp_file, plot_file)
+
+def submit_plot(profiles, title, style, fmt, plot_file):
+    """Render a plot in the renderer pool and save it to the cache.
+    Returns a future that's done once the plot file is saved."""
+    saved = Future()
+    def save(rendered):
+        try:
+            save_plot(rendered, plot_file)
+            saved.set_result(plot_file)
+        except Exception as e:
+            saved.set_exception(e)
+    future = renderers.submit(render_profile_plot, profiles,
+                              get_layer_levels(), title, style, fmt)
+    # the render future's waiters wake up before its callbacks run, so
+    # wait on the save instead
+    future.add_done_callback(save)
+    return saved
+
+cmaq_version = str(int(os.path.getmtime(cmaq_file)))
+renderers = ProcessPoolExecutor(max_workers=nrenderers)
+
+def error_response(message, status=400):
+    return make_response(json.dumps({'error': message}), status)
 
 
 @app.route('/cmaq', methods=['GET'])
 def cmaq():
+    """Get species concentration profiles for a latitude, longitude and
+    time."""
     # get the parameters
-    options = request.args.copy()
-    fwds = request.args.getlist('fwd', type=str)
-    results = {}
-
-    # get an id for the simulation
-    sim_id = assign_id()
-    print(sim_id)
-    results['id'] = str(sim_id)
-    # run hysplit and get simulation ID
-    start_time = time.time()
-    end_time = time.time()
-    results['seconds'] = round(end_time - start_time)
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    time_str = request.args.get('time', type=str)
+    species = request.args.getlist('species', type=str) or cmaq_species
+    if lat is None or lon is None or time_str is None:
+        return error_response('lat, lon and time are required')
+    unknown = [ s for s in species if s not in cmaq_species ]
+    if unknown:
+        return error_response('Unknown species: ' + ', '.join(unknown))
+    try:
+        time_index = cmaq_index.get_time_index(parse_time(time_str))
+    except KeyError as e:
+        return error_response(e.args[0], 404)
+    row, col = cmaq_index.get_cells(lat, lon)
+    results = {'latitude': float(cmaq_index.latitude[row, col]),
+               'longitude': float(cmaq_index.longitude[row, col]),
+               'time': str(cmaq_index.times[time_index]),
+               'levels': get_layer_levels().tolist(),
+               'profiles': get_profiles(species, row, col, time_index)}
     return json.dumps(results)
     
 
     
+@app.route('/cmaq_batch', methods=['GET'])
+def cmaq_batch():
+    """Get species concentration profiles for many points (lat and lon
+    given once per point, or sites=all for all the NYS Mesonet sites)
+    from start to end. Returns columnar json, or a numpy .npz file with
+    format=npz."""
+    start_str = request.args.get('start', type=str)
+    end_str = request.args.get('end', type=str)
+    species = request.args.getlist('species', type=str) or cmaq_species
+    if request.args.get('sites', type=str) == 'all':
+        points = get_sites()
+    else:
+        points = pd.DataFrame({'latitude': request.args.getlist('lat', type=float),
+                               'longitude': request.args.getlist('lon', type=float)})
+    if start_str is None or end_str is None:
+        return error_response('start and end are required')
+    if len(points) == 0:
+        return error_response('no points requested')
+    unknown = [ s for s in species if s not in cmaq_species ]
+    if unknown:
+        return error_response('Unknown species: ' + ', '.join(unknown))
+    try:
+        times = cmaq_index.get_time_range(parse_time(start_str),
+                                          parse_time(end_str))
+    except KeyError as e:
+        return error_response(e.args[0], 404)
+    rows, cols = cmaq_index.get_cells(points['latitude'].values,
+                                      points['longitude'].values)
+    profiles = get_batch_profiles(species, rows, cols, times)
+    columns = {'time': cmaq_index.times[times].astype(str),
+               'level': get_layer_levels(),
+               'latitude': cmaq_index.latitude[rows, cols],
+               'longitude': cmaq_index.longitude[rows, cols]}
+    if 'stid' in points:
+        columns['stid'] = points['stid'].values.astype(str)
+    if request.args.get('format', type=str) == 'npz':
+        f = io.BytesIO()
+        np.savez(f, **columns, **profiles)
+        f.seek(0)
+        return send_file(f, attachment_filename='cmaq.npz',
+                         mimetype='application/octet-stream')
+    results = { k: v.tolist() for k, v in columns.items() }
+    results['dims'] = ['time', 'level', 'point']
+    results['profiles'] = { s: p.tolist() for s, p in profiles.items() }
+    return json.dumps(results)
+
+@app.route('/cmaq_plot', methods=['GET'])
+def cmaq_plot():
+    """Get a profile plot for a NYS Mesonet site (site) or latitude and
+    longitude, at a time. style can be linear or log, and format png or
+    svg."""
+    time_str = request.args.get('time', type=str)
+    species = request.args.getlist('species', type=str) or cmaq_species
+    style = request.args.get('style', 'linear', type=str)
+    fmt = request.args.get('format', 'png', type=str)
+    stid = request.args.get('site', type=str)
+    if stid is not None:
+        sites = get_sites().set_index('stid')
+        if stid not in sites.index:
+            return error_response('Unknown site: ' + stid, 404)
+        lat, lon = sites.loc[stid, ['latitude', 'longitude']]
+        location = stid
+    else:
+        lat = request.args.get('lat', type=float)
+        lon = request.args.get('lon', type=float)
+        if lat is None or lon is None:
+            return error_response('site or lat and lon are required')
+        location = '%.4f,%.4f' % (lat, lon)
+    if time_str is None:
+        return error_response('time is required')
+    if style not in plot_styles or fmt not in plot_formats:
+        return error_response('Unknown style or format')
+    unknown = [ s for s in species if s not in cmaq_species ]
+    if unknown:
+        return error_response('Unknown species: ' + ', '.join(unknown))
+    time = parse_time(time_str)
+    try:
+        time_index = cmaq_index.get_time_index(time)
+    except KeyError as e:
+        return error_response(e.args[0], 404)
+    plot_file = get_plot_file(location, time, species, style, fmt)
+    if not os.path.exists(plot_file):
+        row, col = cmaq_index.get_cells(lat, lon)
+        profiles = get_profiles(species, row, col, time_index)
+        title = location + ' ' + time.strftime('%Y-%m-%d %H:%M UTC')
+        with timed('plot_render'):
+            submit_plot(profiles, title, style, fmt, plot_file).result()
+    return send_file(plot_file, mimetype=plot_formats[fmt])
+
+@app.route('/cmaq_prerender', methods=['POST'])
+def cmaq_prerender():
+    """Render the plots for all the NYS Mesonet sites for a day in the
+    background, to run after a new CMAQ run is available."""
+    date = parse_time(request.args['date'])
+    species = request.args.getlist('species', type=str) or cmaq_species
+    style = request.args.get('style', 'linear', type=str)
+    fmt = request.args.get('format', 'png', type=str)
+    try:
+        times = cmaq_index.get_time_range(date, date + datetime.timedelta(hours=23))
+    except KeyError as e:
+        return error_response(e.args[0], 404)
+    sites = get_sites()
+    rows, cols = cmaq_index.get_cells(sites['latitude'].values,
+                                      sites['longitude'].values)
+    # read the whole day at once
+    profiles = get_batch_profiles(species, rows, cols, times)
+    nplots = 0
+    for t, time in enumerate(pd.to_datetime(cmaq_index.times[times])):
+        for p, stid in enumerate(sites['stid']):
+            plot_file = get_plot_file(stid, time, species, style, fmt)
+            if os.path.exists(plot_file):
+                continue
+            plot_profiles = { s: profiles[s][t, :, p] for s in species }
+            title = stid + ' ' + time.strftime('%Y-%m-%d %H:%M UTC')
+            submit_plot(plot_profiles, title, style, fmt, plot_file)
+            nplots += 1
+    return json.dumps({'plots': nplots})
+
+    
 # useful
 def shutdown_server():
     func = request.environ.get('werkzeug.server.shutdown')
@@ -14,18 +14,27 @@ outside_sites = ['http://pireds.asrc.cestm.albany.edu',
                  'nysmesonet.org', 'www.nysmesonet.org',
                  'xwww.nysmesonet.org']
 cors = CORS(app, resources={r"/*": {'origins': outside_sites}})
+import server_metrics
+from server_metrics import timed
+server_metrics.init_app(app)
 
-import json, os, datetime, time, shutil
+import json, os, re, datetime, time, shutil, select, threading, hashlib
 from subprocess import call
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import create_engine
 import pandas as pd
+import psycopg2
 import hysplit_common
+# record the contouring, geo2topo etc. times with the request timings
+hysplit_common.stage_observers.append(server_metrics.observe_stage)
 # This 'engine' is a connection manager, *NOT* the connection
 # itself. No need to close it.
 pg = create_engine('postgresql:///hysplit_xcite')
 
 # number of processors for parallel processing
 nprocessors = 4
+# number of HYSPLIT runs that can go at the same time
+nslots = max(1, os.cpu_count() // nprocessors)
 # default control files
 single_traj_default = 'CONTROL_single_traj'
 ens_traj_default = 'CONTROL_ens_traj'
@@ -67,15 +76,37 @@ def assign_id():
 def assign_id2(time_id, fwd):
     query = ("insert into simulations (site_id, time_id, forward) values (null," +
              str(time_id) + ",'" + str(fwd) + "') returning id")
-    with pg.connect() as con:
+    with timed('db_query'), pg.connect() as con:
         rs = con.execute(query)
     return list(rs)[0][0]
 
-def get_time_from_id(time_id):
-    query = "select time from available_times where id=" + str(time_id)
+# available_times id -> time map, so the start time doesn't need to be
+# looked up for each run. A time never changes once it's added, so the
+# map only needs to be refreshed when an unknown id shows up.
+available_times = {}
+
+def refresh_available_times():
+    query = "select id, time from available_times"
     with pg.connect() as con:
         rs = con.execute(query)
-    return list(rs)[0][0]
+    available_times.update(dict(list(rs)))
+
+def get_time_from_id(time_id):
+    if time_id not in available_times:
+        refresh_available_times()
+    return available_times[time_id]
+
+# control file templates, reread only when the file changes
+control_templates = {}
+
+def get_control_template(file):
+    path = hysplit_dir + file
+    mtime = os.path.getmtime(path)
+    if file not in control_templates or control_templates[file][0] != mtime:
+        with open(path, 'r') as f:
+            control_templates[file] = (mtime, f.readlines())
+    # return a copy, since update_control modifies it
+    return list(control_templates[file][1])
 
 def get_met_file(time):
     # put together the met data file name
@@ -90,7 +121,89 @@ def get_met_file(time):
     time2_str = time.strftime(time_format)
     return 'hysplit.hrrr.' + time1_str + '-' + time2_str + '.sml'
 
-def update_control(control, options):
+# index of the available met files, mapping file names to the (start,
+# end) times in the name. Built at startup and refreshed periodically so
+# requests can be checked before any HYSPLIT processes are started.
+met_index = {}
+met_index_time = 0
+# how often to refresh the index, in seconds
+met_index_interval = 300
+met_file_pattern = re.compile(r'^hysplit\.hrrr\.(\d{8}\.\d{2}z)-(\d{8}\.\d{2}z)\.sml$')
+
+def get_met_dir():
+    # the met data directory is given in the control files
+    met_dir = get_control_template(conc_default)[7].strip()
+    return os.path.join(hysplit_dir, met_dir)
+
+def refresh_met_index():
+    global met_index, met_index_time
+    index = {}
+    time_format = '%Y%m%d.%Hz'
+    for entry in os.scandir(get_met_dir()):
+        match = met_file_pattern.match(entry.name)
+        # skip empty files that are still being downloaded
+        if match and entry.stat().st_size > 0:
+            index[entry.name] = tuple( datetime.datetime.strptime(t, time_format)
+                                       for t in match.groups() )
+    met_index = index
+    met_index_time = time.time()
+    # keep the newest met file in the page cache
+    if index:
+        newest = max(index, key=lambda f: index[f][1])
+        prefetch_met_file(newest)
+
+def prefetch_met_file(met_file):
+    # ask the OS to start reading the file into the page cache, so
+    # HYSPLIT doesn't have to wait on the disk
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(os.path.join(get_met_dir(), met_file), os.O_RDONLY)
+    except OSError:
+        # it's only a hint, HYSPLIT will report any real problems
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+def update_met_index():
+    while True:
+        time.sleep(met_index_interval)
+        try:
+            refresh_met_index()
+        except Exception as e:
+            print('Met file index refresh failed: ' + str(e))
+
+def check_met_file(start_time):
+    met_file = get_met_file(start_time)
+    if met_file not in met_index and time.time() - met_index_time > 60:
+        # the file may have shown up since the last refresh
+        refresh_met_index()
+    if met_file not in met_index:
+        raise Exception('Meteorological data file ' + met_file +
+                        ' is not available')
+    prefetch_met_file(met_file)
+    return met_file
+
+# HYSPLIT runs are sent through a queue to a fixed set of long-lived
+# worker threads, one per slot, so back-to-back requests don't start
+# more MPI jobs than there are processors for
+hysplit_pool = ThreadPoolExecutor(max_workers=nslots)
+
+def run_command(command, cwd):
+    # time each program (the MPI runs are recorded as mpirun)
+    stage = command[0] if isinstance(command, list) else command
+    with timed(stage):
+        return call(command, cwd=cwd)
+
+def submit_command(command):
+    # run the command in the current directory, even if the directory
+    # changes before a slot is free. Returns a future with the exit
+    # code.
+    return hysplit_pool.submit(run_command, command, os.getcwd())
+
+def update_control(control, options, start_time):
     # get control options
     lat = options.get('lat', type=float)
     lon = options.get('lon', type=float)
@@ -99,11 +212,9 @@ def update_control(control, options):
         fwd = True
     else:
         fwd = False
-    time_id = options.get('time_id', type=int)
     height = options.get('height', type=float)
     records = options.get('records', type=int)
 
-    start_time = get_time_from_id(time_id)
     print('Start time:')
     print(start_time)
     control[0] = start_time.strftime('%y %m %d %H') + '\n'
@@ -116,16 +227,25 @@ def update_control(control, options):
         f.writelines(control)
     return control
 
-def run_hysplit_variant(default, control_file, options, command):
-    control = update_control(default, options)
+def start_hysplit_variant(default, control_file, options, start_time,
+                          command):
+    control = update_control(default, options, start_time)
     # this control file isn't used by hysplit, it's just there to save
     # the control settings used for the run, in case someone wants to
     # look at it later
     with open(control_file, 'w') as f:
         f.writelines(control)
     # this is for parallel processing:
-    response = call(['mpirun', '-np', str(nprocessors), command])
     # response = call(command)
+    return submit_command(['mpirun', '-np', str(nprocessors), command])
+
+def run_hysplit_variant(default, control_file, options, start_time,
+                        command):
+    run = start_hysplit_variant(default, control_file, options,
+                                start_time, command)
+    check_hysplit_response(run.result())
+
+def check_hysplit_response(response):
     if int(response) == 132:
         # This value is the result of the 'STOP 900' line from
         # hysplit, indicating something went wrong. The linux exit
@@ -133,39 +253,41 @@ def run_hysplit_variant(default, control_file, options, command):
         # shell.
         raise Exception('HYSPLIT simulation failed')
 
-def run_single_traj(options, default):
+def run_single_traj(options, default, start_time):
     # copy setup.cfg file first
     shutil.copy('/home/xcite/hysplit/SETUP.trj.CFG', './SETUP.CFG')
-    run_hysplit_variant(default, single_traj_file, options, 'hytm_std')
+    run_hysplit_variant(default, single_traj_file, options, start_time,
+                        'hytm_std')
 
-def run_ens_traj(options, default):
+def run_ens_traj(options, default, start_time):
     # copy setup.cfg file first
     shutil.copy('/home/xcite/hysplit/SETUP.trj.CFG', './SETUP.CFG')
     # command doesn't exist!
     # run_hysplit_variant(default, ens_traj_file, options, 'hytm_ens')
-    control = update_control(default, options)
+    control = update_control(default, options, start_time)
     with open(ens_traj_file, 'w') as f:
         f.writelines(control)
-    call('hyts_ens')
+    submit_command('hyts_ens').result()
 
-def run_conc(options, default):
+def start_conc(options, default, start_time):
     # copy setup.cfg file first
     shutil.copy('/home/xcite/hysplit/SETUP.dis.CFG', './SETUP.CFG')
-    run_hysplit_variant(default, conc_file, options, 'hycm_std')
-    # convert cdump binary file to netcdf
-    call(['conc2cdf', '-icdump', '-ocdump.nc'])
+    # (hysplit_common reads the cdump binary file directly, no need to
+    # convert it to netcdf)
+    return start_hysplit_variant(default, conc_file, options, start_time,
+                                 'hycm_std')
 
 def run_hysplit(options, sim_id):
     # make sure we start in the right folder
     os.chdir(hysplit_dir)
     
     # get the default control files
-    with open(single_traj_default, 'r') as f:
-        single_traj_control = f.readlines()
-    with open(ens_traj_default, 'r') as f:
-        ens_traj_control = f.readlines()
-    with open(conc_default, 'r') as f:
-        conc_control = f.readlines()
+    single_traj_control = get_control_template(single_traj_default)
+    ens_traj_control = get_control_template(ens_traj_default)
+    conc_control = get_control_template(conc_default)
+    # get the start time once for all the runs
+    start_time = get_time_from_id(options.get('time_id', type=int))
+    check_met_file(start_time)
 
     # move to the data directory
     print(str(sim_id))
@@ -181,9 +303,9 @@ def run_hysplit(options, sim_id):
     os.chdir(fwd_dir)
 
     # run the simulations
-    run_single_traj(options, single_traj_control)
-    run_ens_traj(options, ens_traj_control)
-    run_conc(options, conc_control)
+    run_single_traj(options, single_traj_control, start_time)
+    run_ens_traj(options, ens_traj_control, start_time)
+    conc_run = start_conc(options, conc_control, start_time)
 
     # single trajectory output gets written to the wrong file with
     # parallel processing, change it back
@@ -192,13 +314,20 @@ def run_hysplit(options, sim_id):
     shutil.copy(single_traj_output_wrong, single_traj_output)
     # call(['cp', single_traj_output_wrong, single_traj_output])
 
-    # convert to topojson etc
+    # add the trajectory metadata while the concentration model runs
     controls = {'single_trajectory': single_traj_file,
                 'ens_trajectory': ens_traj_file,
                 'concentration': conc_file}
+    try:
+        metadata = hysplit_common.write_trajectory_metadata(pg, fwd, controls,
+                                                            sim_id)
+    finally:
+        check_hysplit_response(conc_run.result())
+
+    # convert to topojson etc
     hysplit_common.write_json_files(pg, str(sim_id) + '/', fwd,
                                     site_dir, quantize, './', controls,
-                                    sim_id)
+                                    sim_id, metadata=metadata)
 
     # remove the unneeded directory
     shutil.rmtree(site_dir)
@@ -209,14 +338,14 @@ def run_hysplit(options, sim_id):
 def get_metadata(site_id, time_id, fwd, sim_id=None):
     if sim_id is not None:
         # get the metadata json as a string
-        query = ("select jsonb_build_object('id', id, 'metadata', metadata)::text from simulations where id=" +
+        query = ("select jsonb_build_object('id', id, 'metadata', metadata, 'progress', progress)::text from simulations where id=" +
                  str(sim_id))
     else:
         # get the metadata json as a string
-        query = ("select jsonb_build_object('id', id, 'metadata', metadata)::text from simulations where site_id=" +
+        query = ("select jsonb_build_object('id', id, 'metadata', metadata, 'progress', progress)::text from simulations where site_id=" +
                  str(site_id) + " and time_id=" + str(time_id) +
                  " and forward=" + str(fwd))
-    with pg.connect() as con:
+    with timed('db_query'), pg.connect() as con:
         rs = con.execute(query)
     return list(rs)[0][0]
 
@@ -225,11 +354,19 @@ def get_contours(sim_id, height, time):
     query = ("select topojson::text from contours where simulation_id=" +
              str(sim_id) + " and height=" + str(height) +
              " and time=" + str(time))
-    with pg.connect() as con:
+    with timed('db_query'), pg.connect() as con:
         rs = con.execute(query)
     return list(rs)[0][0]
 
 
+# warm up the caches
+refresh_available_times()
+for control_default in [single_traj_default, ens_traj_default, conc_default]:
+    get_control_template(control_default)
+refresh_met_index()
+threading.Thread(target=update_met_index, daemon=True).start()
+
+
 @app.route('/', methods=['POST', 'GET'])
 def hysplit():
     if request.method == 'POST':
@@ -272,6 +409,25 @@ def hysplit2():
         time_id = request.args.get('time_id', type=int)
         fwds = request.args.getlist('fwd', type=str)
         results = {}
+        # make sure the time and its met data exist before adding any
+        # simulations
+        error = None
+        if time_id is None:
+            error = 'time_id is required'
+        else:
+            try:
+                sim_start = get_time_from_id(time_id)
+            except KeyError:
+                error = 'Unknown time_id: ' + str(time_id)
+        if error is None:
+            try:
+                check_met_file(sim_start)
+            except Exception as e:
+                error = str(e)
+        if error is not None:
+            results['fwd'] = results['bwd'] = None
+            results['error'] = error
+            return json.dumps(results)
         # run hysplit and get simulation ID
         start_time = time.time()
         if 'true' in fwds:
@@ -305,19 +461,70 @@ def hysplit2():
         return 'Must send a POST request to run HYSPLIT, instead sent a ' + request.method + ' request.'
 
 
+# The sites and times responses only change when hysplit2json runs, so
+# they're kept in memory and refreshed when hysplit2json sends a
+# postgres notification
+snapshots = {}
+
+def make_snapshot(body):
+    return {'body': body, 'etag': hashlib.md5(body.encode()).hexdigest()}
+
+def refresh_sites():
+    site_query = 'select id, stid, name, latitude, longitude from sites order by name'
+    df = pd.read_sql(site_query, pg)
+    snapshots['sites'] = make_snapshot(df.to_json(orient='records'))
+
+def refresh_times():
+    site_query = "select id, time from available_times where active='true' order by time desc"
+    df = pd.read_sql(site_query, pg, index_col='id')
+    snapshots['times'] = make_snapshot(df.to_json(orient='split', date_format='iso', date_unit='s'))
+
+def listen_for_updates():
+    refreshers = {'sites_changed': refresh_sites,
+                  'times_changed': refresh_times}
+    while True:
+        try:
+            conn = psycopg2.connect('dbname=hysplit_xcite')
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                for channel in refreshers:
+                    cur.execute('listen ' + channel)
+            # catch anything that changed while we weren't listening
+            for refresh in refreshers.values():
+                refresh()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                channels = set( n.channel for n in conn.notifies )
+                conn.notifies.clear()
+                for channel in channels:
+                    refreshers[channel]()
+        except Exception as e:
+            # keep the snapshots we have and try again
+            print('Lost notification connection: ' + str(e))
+            time.sleep(10)
+
+def snapshot_response(name):
+    snapshot = snapshots[name]
+    response = make_response(snapshot['body'])
+    response.set_etag(snapshot['etag'])
+    # sends a 304 if the client already has this version
+    return response.make_conditional(request)
+
+refresh_sites()
+refresh_times()
+threading.Thread(target=listen_for_updates, daemon=True).start()
+
 # get the available sites!
 @app.route('/sites', methods=['GET'])
 def sites():
-    site_query = 'select id, stid, name, latitude, longitude from sites order by name'
-    df = pd.read_sql(site_query, pg)
-    return df.to_json(orient='records')
+    return snapshot_response('sites')
 
 # get the available times!
 @app.route('/times', methods=['GET'])
 def times():
-    site_query = "select id, time from available_times where active='true' order by time desc"
-    df = pd.read_sql(site_query, pg, index_col='id')
-    return df.to_json(orient='split', date_format='iso', date_unit='s')
+    return snapshot_response('times')
 
 # get metadata
 @app.route('/metadata', methods=['GET'])
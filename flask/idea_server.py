@@ -5,18 +5,34 @@
 # python3 -m flask run --host=0.0.0.0 --with-threads --port=2112
 
 # setup flask
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, Response, request, send_file, jsonify
 from flask_cors import CORS, cross_origin
 app = Flask(__name__)
 outside_sites = ['http://pireds.asrc.cestm.albany.edu']
 cors = CORS(app, resources={r"/*": {'origins': outside_sites}})
+import server_metrics
+from server_metrics import timed
+server_metrics.init_app(app)
 
-import io, psycopg2, datetime
+import io, os, re, glob, json, base64, struct, zlib, uuid, psycopg2, datetime, bisect
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import create_engine
 import pandas as pd
+from osgeo import gdal
 
 pg = create_engine('postgresql:///lidar')
 iso_fmt = '%Y-%m-%dT%H:%M:%S.000Z'
+# cloud-optimized geotiffs are saved here
+cog_dir = '/home/xcite/idea/cog/'
+cog_blocksize = 256
+# number of database connections used to render animation frames
+nframe_workers = 4
+frame_pool = ThreadPoolExecutor(max_workers=nframe_workers)
+# downsampling factors of the swath and NWP overview tables
+overview_factors = [2, 4, 8]
+# apply colormaps and make pngs in the flask workers instead of postgres
+python_colormaps = True
 
 # set up some postGIS colormaps
 # transparent-blue
@@ -32,6 +48,14 @@ blue_orange = '''100% 251 141 4 255
 0 55 104 251 255
 nodata 0 0 0 0'''
 
+# scale factors for bands stored as scaled 16-bit integers
+def get_band_scales():
+    '''Get the (scale_factor, add_offset) pairs for each type of band'''
+    q = 'select variable, scale_factor, add_offset from idea.band_scales'
+    df = pd.read_sql(q, pg)
+    return { r.variable: (r.scale_factor, r.add_offset) for r in df.itertuples() }
+band_scales = get_band_scales()
+
 
 # helper functions
 def get_time_arg(req, arg):
@@ -39,30 +63,300 @@ def get_time_arg(req, arg):
     time_str = req.args[arg]
     return datetime.datetime.strptime(time_str, iso_fmt)
 
-def get_png(table, column, band, time, colormap, hr):
+def get_size_args(req):
+    '''Get the requested output width and height from the url arguments
+    (either can be missing)'''
+    return req.args.get('width', type=int), req.args.get('height', type=int)
+
+def get_overview_table(table, factor):
+    '''Get the name of a raster table's overview table'''
+    schema, name = table.split('.')
+    return '%s.o_%d_%s' % (schema, factor, name)
+
+def choose_overview(table, column, time, hr, width, height):
+    '''Get the most downsampled version of a raster table that still
+    has at least the requested output width and height'''
+    if width is None and height is None:
+        return table
+    # only reads the raster headers
+    q = ("select ST_Width(%s), ST_Height(%s) from %s where time='%s' and high_resolution=%s" %
+         (column, column, table, time, hr))
+    with timed('db_query'):
+        size = pg.execute(q).first()
+    if size is None:
+        return table
+    for factor in reversed(overview_factors):
+        if ((width is None or size[0] / factor >= width) and
+            (height is None or size[1] / factor >= height)):
+            # rasters loaded before the overviews existed don't have
+            # them, so try the finer levels
+            overview_table = get_overview_table(table, factor)
+            q = ("select exists(select 1 from %s where time='%s' and high_resolution=%s)" %
+                 (overview_table, time, hr))
+            with timed('db_query'):
+                if pg.execute(q).scalar():
+                    return overview_table
+    return table
+
+def scaled_sql(column, band):
+    '''SQL checking if a raster band is stored as scaled integers'''
+    return "ST_BandPixelType(%s, %s)='16BSI'" % (column, band)
+
+def scale_colormap(colormap, scale_factor, add_offset):
+    '''Convert the values in a postGIS colormap to scaled integer
+    values'''
+    lines = []
+    for line in colormap.split('\n'):
+        value, color = line.split(' ', 1)
+        if not value.endswith('%') and value != 'nodata':
+            value = '%g' % ((float(value) - add_offset) / scale_factor)
+        lines.append(value + ' ' + color)
+    return '\n'.join(lines)
+
+def colormap_sql(column, band, rast, rast_band, colormap, variable):
+    '''SQL to apply a colormap to a raster band, using a scaled colormap
+    if the band is stored as scaled integers'''
+    cmap_sql = "ST_ColorMap(%s, %s, '%s')"
+    float_sql = cmap_sql % (rast, rast_band, colormap)
+    if variable not in band_scales:
+        return float_sql
+    scaled_cmap = scale_colormap(colormap, *band_scales[variable])
+    int_sql = cmap_sql % (rast, rast_band, scaled_cmap)
+    return ('(case when %s then %s else %s end)' %
+            (scaled_sql(column, band), int_sql, float_sql))
+
+def decode_sql(column, bands, variables):
+    '''SQL to get raster bands as floats, converting any bands stored as
+    scaled integers'''
+    rast = "ST_Band(%s, '{%s}'::int[])" % (column, ','.join(map(str, bands)))
+    if not all( v in band_scales for v in variables ):
+        return rast
+    reclassargs = []
+    for i, variable in enumerate(variables):
+        scale_factor, add_offset = band_scales[variable]
+        # map the integers linearly back to the original values
+        expr = '[-32767-32767]:%g-%g' % (add_offset - 32767 * scale_factor,
+                                         add_offset + 32767 * scale_factor)
+        reclassargs.append("ROW(%s, '%s', '32BF', -9999)::reclassarg" %
+                           (i + 1, expr))
+    int_sql = 'ST_Reclass(%s, %s)' % (rast, ', '.join(reclassargs))
+    return ('(case when %s then %s else %s end)' %
+            (scaled_sql(column, bands[0]), int_sql, rast))
+
+def png_sql(column, band, colormap, variable, wgs84=False):
+    '''SQL to get a png of a raster band, optionally transformed to web
+    mercator'''
+    if wgs84:
+        rast = 'ST_Transform(ST_Band(%s, %s), 3857)' % (column, band)
+        cmap_sql = colormap_sql(column, band, rast, 1, colormap, variable)
+    else:
+        cmap_sql = colormap_sql(column, band, column, band, colormap, variable)
+    return "ST_AsPNG(%s, '{1,2,3,4}'::int[])" % cmap_sql
+
+# python colormaps
+
+# numpy types of the postGIS pixel types
+wkb_pixtypes = {0: 'u1', 1: 'u1', 2: 'u1', 3: 'i1', 4: 'u1', 5: 'i2',
+                6: 'u2', 7: 'i4', 8: 'u4', 10: 'f4', 11: 'f8'}
+# number of colors in the colormap lookup tables
+lut_size = 65536
+
+def read_raster_wkb(wkb):
+    '''Read the first band of a postGIS raster WKB into an array. Returns
+    the array and the band's nodata value.'''
+    endian = '<' if wkb[0] == 1 else '>'
+    # skip the georeferencing in the raster header
+    width, height = struct.unpack(endian + 'HH', wkb[57:61])
+    flags = wkb[61]
+    dtype = np.dtype(wkb_pixtypes[flags & 0x0f]).newbyteorder(endian)
+    nodata = np.frombuffer(wkb, dtype, 1, 62)[0] if flags & 0x40 else None
+    pixels = np.frombuffer(wkb, dtype, width * height, 62 + dtype.itemsize)
+    return pixels.reshape(height, width), nodata
+
+def parse_colormap(colormap):
+    '''Split a postGIS colormap into (value, rgba) entries and the nodata
+    color'''
+    entries = []
+    nodata_color = [0, 0, 0, 0]
+    for line in colormap.split('\n'):
+        value, *color = line.split()
+        color = list(map(int, color))
+        if value == 'nodata':
+            nodata_color = color
+        else:
+            entries.append((value, color))
+    return entries, nodata_color
+
+def make_lut(entries, lo, hi):
+    '''Make a lookup table of colors for lut_size values evenly spaced
+    from lo to hi, interpolating between the colormap entries like
+    ST_ColorMap. Percentages are relative to lo and hi.'''
+    points = []
+    for value, color in entries:
+        if value.endswith('%'):
+            value = lo + float(value[:-1]) / 100 * (hi - lo)
+        points.append((float(value), color))
+    points.sort(key=lambda p: p[0])
+    xp = [ p[0] for p in points ]
+    values = np.linspace(lo, hi, lut_size)
+    lut = np.stack([ np.interp(values, xp, [ p[1][i] for p in points ])
+                     for i in range(4) ], axis=-1)
+    return lut.round().astype(np.uint8)
+
+def apply_colormap(values, valid, colormap):
+    '''Get an RGBA array from an array of values using a postGIS
+    colormap'''
+    entries, nodata_color = parse_colormap(colormap)
+    rgba = np.empty(values.shape + (4,), dtype=np.uint8)
+    rgba[:] = nodata_color
+    if not valid.any():
+        return rgba
+    lo = values[valid].min()
+    hi = values[valid].max()
+    lut = make_lut(entries, lo, hi)
+    scale = (lut_size - 1) / (hi - lo) if hi > lo else 0
+    index = np.clip(np.round((values[valid] - lo) * scale), 0, lut_size - 1)
+    rgba[valid] = lut[index.astype(np.intp)]
+    return rgba
+
+def encode_png(rgba):
+    '''Encode an RGBA array as a png'''
+    height, width = rgba.shape[:2]
+    # each row starts with its filter type, 0 (none)
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+    def chunk(tag, data):
+        return (struct.pack('!I', len(data)) + tag + data +
+                struct.pack('!I', zlib.crc32(tag + data) & 0xffffffff))
+    ihdr = struct.pack('!IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) +
+            chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) + chunk(b'IEND', b''))
+
+def render_png(table, rast, time, hr, colormap, variable):
+    '''Get a raster band from postgres and make a png of it in python'''
+    q = ("select ST_AsBinary(%s) from %s where time='%s' and high_resolution=%s" %
+         (rast, table, time, hr))
+    with timed('db_query'):
+        wkb = bytes(pg.execute(q).scalar())
+    pixels, nodata = read_raster_wkb(wkb)
+    values = pixels.astype(float)
+    valid = ~np.isnan(values)
+    if nodata is not None:
+        valid &= pixels != nodata
+    # decode scaled integer bands
+    if pixels.dtype.kind == 'i' and pixels.itemsize == 2 and variable in band_scales:
+        scale_factor, add_offset = band_scales[variable]
+        values = values * scale_factor + add_offset
+    with timed('raster_render'):
+        png = encode_png(apply_colormap(values, valid, colormap))
+    return io.BytesIO(png)
+
+def get_png(table, column, band, time, colormap, hr, variable):
     '''Get a png from postgres'''
-    band_query = ("select ST_AsPNG(ST_ColorMap(%s, %s, '%s'), '{1,2,3,4}'::int[]) from %s where time='%s' and high_resolution=%s" %
-                  (column, band, colormap, table, time, hr))
+    if python_colormaps:
+        rast = 'ST_Band(%s, %s)' % (column, band)
+        return render_png(table, rast, time, hr, colormap, variable)
+    band_query = ("select %s from %s where time='%s' and high_resolution=%s" %
+                  (png_sql(column, band, colormap, variable), table, time, hr))
     # get data from postgres
-    with psycopg2.connect("dbname=lidar user=will") as conn:
+    with timed('raster_render'), psycopg2.connect("dbname=lidar user=will") as conn:
         with conn.cursor() as cur:
             cur.execute("SET postgis.gdal_enabled_drivers = 'ENABLE_ALL';")
             cur.execute(band_query)
             res = cur.fetchone()
     return io.BytesIO(res[0].tobytes())
 
-def get_wgs84_png(table, column, band, time, colormap, hr):
+def get_wgs84_png(table, column, band, time, colormap, hr, variable):
     '''Get a png from postgres'''
-    band_query = ("select ST_AsPNG(ST_ColorMap(ST_Transform(ST_Band(%s, %s), 3857), 1, '%s'), '{1,2,3,4}'::int[]) from %s where time='%s' and high_resolution=%s" %
-                  (column, band, colormap, table, time, hr))
+    if python_colormaps:
+        rast = 'ST_Transform(ST_Band(%s, %s), 3857)' % (column, band)
+        return render_png(table, rast, time, hr, colormap, variable)
+    band_query = ("select %s from %s where time='%s' and high_resolution=%s" %
+                  (png_sql(column, band, colormap, variable, wgs84=True),
+                   table, time, hr))
     # get data from postgres
-    with psycopg2.connect("dbname=lidar user=will") as conn:
+    with timed('raster_render'), psycopg2.connect("dbname=lidar user=will") as conn:
         with conn.cursor() as cur:
             cur.execute("SET postgis.gdal_enabled_drivers = 'ENABLE_ALL';")
             cur.execute(band_query)
             res = cur.fetchone()
     return io.BytesIO(res[0].tobytes())
 
+def get_tiff(query):
+    '''Get a geotiff from postgres'''
+    with timed('raster_render'), psycopg2.connect("dbname=lidar user=will") as conn:
+        with conn.cursor() as cur:
+            cur.execute("SET postgis.gdal_enabled_drivers = 'ENABLE_ALL';")
+            cur.execute(query)
+            res = cur.fetchone()
+    return res[0].tobytes()
+
+def get_row_version(table, time, hr):
+    '''Get the ID of the transaction that last wrote a raster, which
+    changes whenever the raster is updated'''
+    q = ("select xmin::text::bigint from %s where time='%s' and high_resolution=%s" %
+         (table, time, hr))
+    with timed('db_query'):
+        return pg.execute(q).scalar()
+
+def make_cog(tiff_bin, cog_file, resampling):
+    '''Convert a geotiff to a cloud-optimized geotiff: tiled, with
+    internal overviews and DEFLATE compression'''
+    # the server is threaded, so the temporary files need unique names
+    # in case two requests make the same file at once
+    src_file = '/vsimem/%s_%s' % (uuid.uuid4().hex, os.path.basename(cog_file))
+    gdal.FileFromMemBuffer(src_file, tiff_bin)
+    try:
+        mem = gdal.GetDriverByName('MEM').CreateCopy('', gdal.Open(src_file))
+    finally:
+        gdal.Unlink(src_file)
+    # add overviews until the whole raster fits in one tile
+    factors = []
+    factor = 2
+    while max(mem.RasterXSize, mem.RasterYSize) > cog_blocksize * factor // 2:
+        factors.append(factor)
+        factor *= 2
+    if factors:
+        mem.BuildOverviews(resampling, factors)
+    # floating point predictor for float data, horizontal differencing
+    # otherwise
+    is_float = mem.GetRasterBand(1).DataType in (gdal.GDT_Float32, gdal.GDT_Float64)
+    options = ['TILED=YES', 'BLOCKXSIZE=%d' % cog_blocksize,
+               'BLOCKYSIZE=%d' % cog_blocksize, 'COMPRESS=DEFLATE',
+               'PREDICTOR=%d' % (3 if is_float else 2),
+               'COPY_SRC_OVERVIEWS=YES']
+    tmp_file = cog_file + '.tmp' + uuid.uuid4().hex
+    gdal.GetDriverByName('GTiff').CreateCopy(tmp_file, mem, options=options)
+    os.replace(tmp_file, cog_file)
+
+def get_cog(name, key, table, time, hr, query, resampling='AVERAGE'):
+    '''Get the file name of a cached cloud-optimized geotiff, making it
+    if needed. Returns None if the raster doesn't exist.'''
+    version = get_row_version(table, time, hr)
+    if version is None:
+        return None
+    key_str = re.sub('[^0-9A-Za-z]+', '-', '_'.join(map(str, key)))
+    prefix = os.path.join(cog_dir, name + '_' + key_str + '_')
+    cog_file = prefix + str(version) + '.tif'
+    if not os.path.exists(cog_file):
+        os.makedirs(cog_dir, exist_ok=True)
+        tiff_bin = get_tiff(query)
+        with timed('cog_convert'):
+            make_cog(tiff_bin, cog_file, resampling)
+        # remove outdated versions
+        for f in glob.glob(prefix + '*.tif'):
+            if f != cog_file:
+                os.remove(f)
+    return cog_file
+
+def send_cog(cog_file, name):
+    '''Send a cached cloud-optimized geotiff, with support for range
+    requests'''
+    if cog_file is None:
+        return jsonify({'error': 'raster not found'}), 404
+    return send_file(cog_file, attachment_filename=name + '.tif',
+                     mimetype='image/tiff', conditional=True)
+
 
 # get most recent simulation
 @app.route('/most_recent', methods=['GET'])
@@ -74,22 +368,145 @@ def most_recent():
         high_resolution = False
     site_query = ("select lower(time_range) as start_time, upper(time_range) as end_time from idea.simulations where high_resolution=%s order by lower(time_range) desc limit 1" %
                   high_resolution)
-    df = pd.read_sql(site_query, pg)
+    with timed('db_query'):
+        df = pd.read_sql(site_query, pg)
     return df.to_json(orient='records', date_format='iso', date_unit='s')
 
 # get trajectories
+def traj_time_str(time_str):
+    '''Convert a url time argument to the trajectory time format'''
+    return pd.to_datetime(time_str).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def bbox_overlaps(bbox1, bbox2):
+    '''Check if two (xmin, ymin, xmax, ymax) bounding boxes overlap'''
+    return (bbox1[0] <= bbox2[2] and bbox2[0] <= bbox1[2] and
+            bbox1[1] <= bbox2[3] and bbox2[1] <= bbox1[3])
+
+def get_trajectory_window(times, start_time, end_time):
+    '''Get the time offsets of a time window (times are sorted ISO-8601
+    strings)'''
+    i0 = 0
+    i1 = len(times)
+    if start_time is not None:
+        i0 = bisect.bisect_left(times, start_time)
+    if end_time is not None:
+        i1 = bisect.bisect_right(times, end_time)
+    return i0, i1
+
+def segment_in_bbox(line, bbox):
+    '''Check if the bounding box of a trajectory segment overlaps a
+    bounding box, like the trajectory index check'''
+    xs = []
+    ys = []
+    for point in line:
+        x, y = point[:2]
+        # missing points are null or nan
+        if x is None or y is None or x != x or y != y:
+            continue
+        xs.append(x)
+        ys.append(y)
+    if not xs:
+        return False
+    return bbox_overlaps((min(xs), min(ys), max(xs), max(ys)), bbox)
+
+def select_trajectories(index, bbox, i0, i1):
+    '''Get the numbers of the trajectories in a bounding box and time
+    window, using the trajectory index'''
+    keep = []
+    for n, (traj_bbox, offsets) in enumerate(zip(index['bbox'], index['offsets'])):
+        if traj_bbox is None or offsets[1] < i0 or offsets[0] >= i1:
+            continue
+        if bbox is not None and not bbox_overlaps(traj_bbox, bbox):
+            continue
+        keep.append(n)
+    return keep
+
+def fetch_trajectories(sim_id, keep, i0, i1, aod_traj_first):
+    '''Get the coordinates and aod of some of a simulation's
+    trajectories, without sending (or parsing) the rest'''
+    coords_sql = 'jsonb_build_array(%s)' % ', '.join(
+        "trajectories->'geometry'->'coordinates'->%d" % n for n in keep )
+    if aod_traj_first:
+        aod_sql = 'jsonb_build_array(%s)' % ', '.join(
+            "trajectories->'properties'->'aod'->%d" % n for n in keep )
+    else:
+        # the aod is stored as (time, traj), so get the window's rows
+        aod_sql = ("(select coalesce(jsonb_agg(jsonb_build_array(%s) order by i), '[]') from jsonb_array_elements(trajectories->'properties'->'aod') with ordinality as a(elem, i) where i > %d and i <= %d)" %
+                   (', '.join( 'elem->%d' % n for n in keep ), i0, i1))
+    q = ('select %s as coords, %s as aod from idea.simulations where id=%d' %
+         (coords_sql, aod_sql, sim_id))
+    with timed('db_query'):
+        return pg.execute(q).first()
+
+def slice_trajectories(sim_id, times, index, bbox, start_time, end_time):
+    '''Get the trajectory segments in a bounding box and time window,
+    using the trajectory index to only fetch the trajectories that are
+    needed'''
+    if index is None:
+        # simulation was added before the index existed
+        q = 'select trajectories from idea.simulations where id=%d' % sim_id
+        with timed('db_query'):
+            return pg.execute(q).scalar()
+    i0, i1 = get_trajectory_window(times, start_time, end_time)
+    keep = select_trajectories(index, bbox, i0, i1)
+    coords, aod = fetch_trajectories(sim_id, keep, i0, i1,
+                                     index['aod_traj_first'])
+    lines = [ c[i0:i1] for c in coords ]
+    if index['aod_traj_first']:
+        aod = [ a[i0:i1] for a in aod ]
+    if bbox is not None and (i0 > 0 or i1 < len(times)):
+        # the index has the bounding box of the whole trajectory, so
+        # check that the segment in the window is in the bounding box
+        overlaps = [ segment_in_bbox(line, bbox) for line in lines ]
+        keep = [ n for n, o in zip(keep, overlaps) if o ]
+        lines = [ line for line, o in zip(lines, overlaps) if o ]
+        if index['aod_traj_first']:
+            aod = [ a for a, o in zip(aod, overlaps) if o ]
+        else:
+            aod = [ [ v for v, o in zip(row, overlaps) if o ] for row in aod ]
+    mlstring = {'type': 'MultiLineString', 'coordinates': lines}
+    properties = {'times': times[i0:i1], 'aod': aod, 'trajectories': keep}
+    return {'type': 'Feature', 'geometry': mlstring, 'properties': properties}
+
 @app.route('/trajectories', methods=['GET'])
 def trajectories():
+    '''Get the trajectories of simulations overlapping a time range.
+    Optionally, only get trajectories in a bounding box (bbox, as
+    'xmin,ymin,xmax,ymax') and clip them to the time range (clip=true).
+
+    '''
     print(request.args)
     start_time = request.args.get('start_time', type=str)
     end_time = request.args.get('end_time', type=str)
+    bbox_str = request.args.get('bbox', type=str)
+    clip = request.args.get('clip', type=str) == 'true'
     if 'resolution' in request.args.keys():
         high_resolution = request.args['resolution'] == 'high'
     else:
         high_resolution = False
-    site_query = ("select lower(time_range) as start_time, upper(time_range) as end_time, trajectories from idea.simulations where high_resolution=%s and time_range && '(%s, %s)' order by lower(time_range)" %
-                  (high_resolution, start_time, end_time))
-    df = pd.read_sql(site_query, pg)
+    where = ("high_resolution=%s and time_range && '(%s, %s)' order by lower(time_range)" %
+             (high_resolution, start_time, end_time))
+    if bbox_str is None and not clip:
+        site_query = "select lower(time_range) as start_time, upper(time_range) as end_time, trajectories from idea.simulations where " + where
+        with timed('db_query'):
+            df = pd.read_sql(site_query, pg)
+        return df.to_json(orient='records', date_format='iso', date_unit='s')
+    # get the index first, then only the trajectories that are needed
+    site_query = "select id, lower(time_range) as start_time, upper(time_range) as end_time, trajectories->'properties'->'times' as times, trajectory_index from idea.simulations where " + where
+    with timed('db_query'):
+        df = pd.read_sql(site_query, pg)
+    if bbox_str is not None:
+        bbox = list(map(float, bbox_str.split(',')))
+    else:
+        bbox = None
+    if clip:
+        window = (traj_time_str(start_time), traj_time_str(end_time))
+    else:
+        window = (None, None)
+    df['trajectories'] = [ slice_trajectories(sim_id, times, index, bbox, *window)
+                           for sim_id, times, index in zip(df['id'], df['times'],
+                                                           df['trajectory_index']) ]
+    df = df[['start_time', 'end_time', 'trajectories']]
     return df.to_json(orient='records', date_format='iso', date_unit='s')
 
 
@@ -107,21 +524,44 @@ def nwp():
     time = request.args.get('time', type=str)
     band_names = request.args.getlist('band', type=str)
     bands = [ nwp_dict[s] for s in band_names ]
-    bands_str = ','.join(map(str, bands))
-    band_query = "select ST_AsTIFF(ST_Band(nwp, '{%s}'::int[])) from idea.nwp where time='%s' and not high_resolution" % (bands_str, time)
-    # get data from postgres
-    with psycopg2.connect("dbname=lidar user=will") as conn:
-        with conn.cursor() as cur:
-            cur.execute("SET postgis.gdal_enabled_drivers = 'ENABLE_ALL';")
-            cur.execute(band_query)
-            res = cur.fetchone()
-    tiff_bin = res[0].tobytes()
+    variables = [ 'apcp' if s == 'apcp' else 'wind' for s in band_names ]
+    rast = decode_sql('nwp', bands, variables)
+    table = choose_overview('idea.nwp', 'nwp', time, False, *get_size_args(request))
+    band_query = "select ST_AsTIFF(%s) from %s where time='%s' and not high_resolution" % (rast, table, time)
+    if request.args.get('cog', type=str) == 'true':
+        cog_file = get_cog('nwp', [table, time] + band_names, table, time,
+                           False, band_query)
+        return send_cog(cog_file, 'nwp')
+    tiff_bin = get_tiff(band_query)
     return send_file(io.BytesIO(tiff_bin),
                      attachment_filename='nwp.tif',
                      mimetype='application/x-geotiff')
 
+def get_uv_field(time, hr, bands):
+    '''Get a compact binary wind vector field: a line of json with the
+    grid information, followed by the u and v arrays as little-endian
+    float32 values'''
+    variables = ['wind', 'wind']
+    q = ("select ST_AsTIFF(%s) from idea.nwp where time='%s' and high_resolution=%s" %
+         (decode_sql('nwp', bands, variables), time, hr))
+    # unique name, since the server is threaded
+    tiff_file = '/vsimem/uv_%s.tif' % uuid.uuid4().hex
+    gdal.FileFromMemBuffer(tiff_file, get_tiff(q))
+    try:
+        r = gdal.Open(tiff_file)
+        uv = r.ReadAsArray().astype('<f4')
+        header = {'width': r.RasterXSize, 'height': r.RasterYSize,
+                  'geotransform': r.GetGeoTransform(),
+                  'nodata': r.GetRasterBand(1).GetNoDataValue()}
+        r = None
+    finally:
+        gdal.Unlink(tiff_file)
+    return (json.dumps(header) + '\n').encode() + uv.tobytes()
+
 @app.route('/wind', methods=['GET'])
 def wind():
+    '''Get a geotiff of wind direction (or speed, with
+    variable=speed), or the wind vector field with format=uv'''
     print(request.args)
     time = request.args['time']
     if 'resolution' in request.args.keys():
@@ -130,24 +570,52 @@ def wind():
         high_resolution = False
     if high_resolution:
         # only PBL winds available
-        bands = [1, 2]
+        level = 0
+        nlevels = 1
     else:
         height = request.args.get('height', type=int)
-        height_n = p_heights.index(height) + 1
-        bands = [height_n, height_n + 3]
-
-    # calculate direction in degrees from the 2 horizontal wind speed
-    # components (the leaflet geotiff add-on requires positive
-    # degrees, measured clockwise from due south)
-    q = ("select ST_AsTIFF(ST_MapAlgebra(nwp, %s, nwp, %s, '(atan2d(-[rast1],-[rast2])+360)::numeric %% 360')) as direction from idea.nwp where time='%s' and high_resolution=%s" %
-         (bands[0], bands[1], time, high_resolution))
-    # get data from postgres
-    with psycopg2.connect("dbname=lidar user=will") as conn:
-        with conn.cursor() as cur:
-            cur.execute("SET postgis.gdal_enabled_drivers = 'ENABLE_ALL';")
-            cur.execute(q)
-            res = cur.fetchone()
-    tiff_bin = res[0].tobytes()
+        level = p_heights.index(height)
+        nlevels = len(p_heights)
+    # u and v bands in idea.nwp
+    uv_bands = [level + 1, level + nlevels + 1]
+    if request.args.get('format', type=str) == 'uv':
+        return send_file(io.BytesIO(get_uv_field(time, high_resolution, uv_bands)),
+                         attachment_filename='wind.bin',
+                         mimetype='application/octet-stream')
+
+    # the directions and speeds are calculated during ingest. The
+    # direction is in positive degrees, measured clockwise from due
+    # south, as required by the leaflet geotiff add-on.
+    variable = request.args.get('variable', 'direction', type=str)
+    if get_row_version('idea.wind', time, high_resolution) is not None:
+        table = 'idea.wind'
+        if variable == 'speed':
+            band = level + nlevels + 1
+            rast = decode_sql('wind', [band], ['wind'])
+        else:
+            band = level + 1
+            rast = decode_sql('wind', [band], ['direction'])
+        q = ("select ST_AsTIFF(%s) from idea.wind where time='%s' and high_resolution=%s" %
+             (rast, time, high_resolution))
+    else:
+        # times loaded before idea.wind existed -- calculate from the u
+        # and v components (decoded, since speed depends on the scale)
+        table = 'idea.nwp'
+        band = None
+        if variable == 'speed':
+            expr = 'sqrt([rast1]^2 + [rast2]^2)'
+        else:
+            expr = '(atan2d(-[rast1],-[rast2])+360)::numeric % 360'
+        uv = decode_sql('nwp', uv_bands, ['wind', 'wind'])
+        q = ("select ST_AsTIFF(ST_MapAlgebra(uv, 1, uv, 2, '%s', '32BF')) from (select %s as uv from idea.nwp where time='%s' and high_resolution=%s) r" %
+             (expr, uv, time, high_resolution))
+    if request.args.get('cog', type=str) == 'true':
+        # averaging directions doesn't work across due south
+        cog_file = get_cog('wind', [table, time, high_resolution, variable, band],
+                           table, time, high_resolution, q,
+                           resampling='NEAREST')
+        return send_cog(cog_file, 'wind')
+    tiff_bin = get_tiff(q)
     return send_file(io.BytesIO(tiff_bin),
                      attachment_filename='wind.tif',
                      mimetype='application/x-geotiff')
@@ -170,7 +638,10 @@ def apcp():
         apcp_band = 3
     else:
         apcp_band = 7
-    return send_file(get_wgs84_png('idea.nwp', 'nwp', apcp_band, time, transp_blue, high_resolution),
+    table = choose_overview('idea.nwp', 'nwp', time, high_resolution,
+                            *get_size_args(request))
+    return send_file(get_wgs84_png(table, 'nwp', apcp_band, time, transp_blue,
+                                   high_resolution, 'apcp'),
                      attachment_filename='apcp.png',
                      mimetype='image/png')
 
@@ -186,7 +657,10 @@ def cod():
         high_resolution = request.args['resolution'] == 'high'
     else:
         high_resolution = False
-    return send_file(get_png('viirs.swaths', 'swath', 2, time, transp_white, high_resolution),
+    table = choose_overview('viirs.swaths', 'swath', time, high_resolution,
+                            *get_size_args(request))
+    return send_file(get_png(table, 'swath', 2, time, transp_white,
+                             high_resolution, 'cod'),
                      attachment_filename='apcp.png',
                      mimetype='image/png')
 
@@ -202,23 +676,141 @@ def aod():
         high_resolution = request.args['resolution'] == 'high'
     else:
         high_resolution = False
-    return send_file(get_png('viirs.swaths', 'swath', 1, time, blue_orange, high_resolution),
+    table = choose_overview('viirs.swaths', 'swath', time, high_resolution,
+                            *get_size_args(request))
+    return send_file(get_png(table, 'swath', 1, time, blue_orange,
+                             high_resolution, 'aod'),
                      attachment_filename='apcp.png',
                      mimetype='image/png')
 
+# animations
+def get_layer_png(layer, hr):
+    '''Get the (table, column, band, colormap, variable, wgs84) of an
+    animated png layer, or None if the layer isn't a png'''
+    if layer == 'apcp':
+        return ('idea.nwp', 'nwp', 3 if hr else 7, transp_blue, 'apcp', True)
+    if layer == 'cod':
+        return ('viirs.swaths', 'swath', 2, transp_white, 'cod', False)
+    if layer == 'aod':
+        return ('viirs.swaths', 'swath', 1, blue_orange, 'aod', False)
+    return None
+
+def get_layer_sql(layer, hr, height=None):
+    '''Get the table, frame SQL and frame format for an animated
+    layer'''
+    png = get_layer_png(layer, hr)
+    if png is not None:
+        table, column, band, colormap, variable, wgs84 = png
+        return (table, png_sql(column, band, colormap, variable, wgs84=wgs84),
+                'png')
+    if layer == 'wind':
+        band = 1 if hr else p_heights.index(height) + 1
+        return ('idea.wind', 'ST_AsTIFF(%s)' % decode_sql('wind', [band], ['direction']),
+                'tiff')
+    raise ValueError('Unknown layer: ' + layer)
+
+def get_layer_times(table, start_time, end_time, hr):
+    '''Get the available times of a layer in a time interval'''
+    q = ("select time from %s where time between '%s' and '%s' and high_resolution=%s order by time asc" %
+         (table, start_time, end_time, hr))
+    with timed('db_query'):
+        df = pd.read_sql(q, pg)
+    return df['time'].dt.to_pydatetime().tolist()
+
+def render_frames(table, frame_sql, times, hr):
+    '''Render the frames for a list of times with a single query'''
+    time_list = ', '.join( "'%s'" % t for t in times )
+    q = ("select time, %s from %s where time in (%s) and high_resolution=%s order by time asc" %
+         (frame_sql, table, time_list, hr))
+    with timed('raster_render'), psycopg2.connect("dbname=lidar user=will") as conn:
+        with conn.cursor() as cur:
+            cur.execute("SET postgis.gdal_enabled_drivers = 'ENABLE_ALL';")
+            cur.execute(q)
+            return [ (t, frame.tobytes()) for t, frame in cur.fetchall() ]
+
+def render_python_frames(table, column, band, colormap, variable, wgs84,
+                         times, hr):
+    '''Render png frames for a list of times with the python
+    colormaps'''
+    if wgs84:
+        rast = 'ST_Transform(ST_Band(%s, %s), 3857)' % (column, band)
+    else:
+        rast = 'ST_Band(%s, %s)' % (column, band)
+    return [ (t, render_png(table, rast, t, hr, colormap, variable).getvalue())
+             for t in times ]
+
+@app.route('/animation', methods=['GET'])
+def animation():
+    '''Get all the frames of a layer (apcp, cod, aod or wind) between
+    start and end as a stream of newline-delimited json, with the
+    base64-encoded frame images. The frames are rendered in parallel,
+    in the render threads if python_colormaps is set, or over several
+    database connections.'''
+    print(request.args)
+    layer = request.args['layer']
+    start_time = get_time_arg(request, 'start')
+    end_time = get_time_arg(request, 'end')
+    if 'resolution' in request.args.keys():
+        high_resolution = request.args['resolution'] == 'high'
+    else:
+        high_resolution = False
+    height = request.args.get('height', type=int)
+    try:
+        table, frame_sql, fmt = get_layer_sql(layer, high_resolution, height)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    times = get_layer_times(table, start_time, end_time, high_resolution)
+    # split the frames between the render workers, keeping them in order
+    nchunks = min(nframe_workers, len(times))
+    chunk_size = -(-len(times) // nchunks) if nchunks else 0
+    png = get_layer_png(layer, high_resolution)
+    if python_colormaps and png is not None:
+        futures = [ frame_pool.submit(render_python_frames, *png,
+                                      times[i:i + chunk_size], high_resolution)
+                    for i in range(0, len(times), chunk_size or 1) ]
+    else:
+        futures = [ frame_pool.submit(render_frames, table, frame_sql,
+                                      times[i:i + chunk_size], high_resolution)
+                    for i in range(0, len(times), chunk_size or 1) ]
+    def generate():
+        for future in futures:
+            for time, frame in future.result():
+                yield json.dumps({'time': time.strftime(iso_fmt),
+                                  'format': fmt,
+                                  'data': base64.b64encode(frame).decode()}) + '\n'
+    return Response(generate(), mimetype='application/x-ndjson')
+
 @app.route('/swaths', methods=['GET'])
 def swaths():
     '''Get the available swath times and domains in a given time interval.
+    Optionally, only get swaths overlapping a longitude/latitude
+    bounding box (bbox, as 'xmin,ymin,xmax,ymax'), and include the
+    swath footprints (footprint=true).
     '''
     print(request.args)
     start_time = get_time_arg(request, 'start')
     end_time = get_time_arg(request, 'end')
+    bbox_str = request.args.get('bbox', type=str)
     if 'resolution' in request.args.keys():
         high_resolution = request.args['resolution'] == 'high'
     else:
         high_resolution = False
-    site_query = "select time, ST_AsGeoJSON(ST_Envelope(swath)) as bounds from viirs.swaths where time between '%s' and '%s' and high_resolution=%s order by time asc" % (start_time, end_time, high_resolution)
-    df = pd.read_sql(site_query, pg)
+    # the envelopes and footprints are calculated during ingest. Swaths
+    # loaded before that fall back to the raster envelope (the rasters
+    # are labeled 4326 but are in web mercator). The swaths table has
+    # an index on this expression.
+    envelope = "coalesce(envelope, ST_SetSRID(ST_Envelope(swath), 3857))"
+    columns = "time, ST_AsGeoJSON(%s, 9, 0) as bounds" % envelope
+    if request.args.get('footprint', type=str) == 'true':
+        columns += ", ST_AsGeoJSON(footprint, 9, 0) as footprint"
+    where = "time between '%s' and '%s' and high_resolution=%s" % (start_time, end_time, high_resolution)
+    if bbox_str is not None:
+        bbox = list(map(float, bbox_str.split(',')))
+        where += (" and %s && ST_Transform(ST_MakeEnvelope(%s, %s, %s, %s, 4326), 3857)" %
+                  ((envelope,) + tuple(bbox)))
+    site_query = "select %s from viirs.swaths where %s order by time asc" % (columns, where)
+    with timed('db_query'):
+        df = pd.read_sql(site_query, pg)
     return df.to_json(orient='records', date_format='iso', date_unit='s')
 
 # band_query = "select ST_AsTIFF(ST_Band(nwp, '{%s}'::int[])) from idea.nwp where time='%s'" % (1, '2018-07-01')
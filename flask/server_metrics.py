@@ -0,0 +1,109 @@
+# request and stage timing shared by the flask servers
+
+# each server calls init_app(app), which times every request and adds
+# a /metrics route with the timings in the prometheus text format.
+# Slow parts of the requests can be timed separately with:
+#   with timed('db_query'):
+#       ...
+
+import time, threading
+from contextlib import contextmanager
+from flask import request, g, make_response
+
+# histogram bucket upper bounds, in seconds
+buckets = [.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120,
+           300, 600]
+
+class Histogram:
+    '''Counts of observations in buckets, like a prometheus histogram'''
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(buckets) and value > buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+# histograms for each metric, keyed by their (sorted) labels
+histograms = {'http_request_duration_seconds': {},
+              'stage_duration_seconds': {}}
+descriptions = {'http_request_duration_seconds': 'Request latency by route.',
+                'stage_duration_seconds': 'Time spent in each stage of the requests.'}
+lock = threading.Lock()
+
+def observe(name, labels, seconds):
+    '''Add an observation to a histogram'''
+    key = tuple(sorted(labels.items()))
+    with lock:
+        hist = histograms[name].get(key)
+        if hist is None:
+            hist = histograms[name][key] = Histogram()
+        hist.observe(seconds)
+
+def observe_stage(stage, seconds):
+    '''Add a stage timing'''
+    observe('stage_duration_seconds', {'stage': stage}, seconds)
+
+@contextmanager
+def timed(stage):
+    '''Time a stage of a request'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+def format_labels(labels):
+    '''Format labels for the prometheus text format'''
+    escaped = ( (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in labels )
+    return '{' + ','.join( '%s="%s"' % kv for kv in escaped ) + '}'
+
+def get_metrics_text():
+    '''Get all the histograms in the prometheus text format'''
+    lines = []
+    with lock:
+        for name, hists in histograms.items():
+            lines.append('# HELP %s %s' % (name, descriptions[name]))
+            lines.append('# TYPE %s histogram' % name)
+            for labels, hist in sorted(hists.items()):
+                # prometheus buckets are cumulative
+                total = 0
+                for le, count in zip(buckets + ['+Inf'], hist.counts):
+                    total += count
+                    bucket_labels = format_labels(labels + (('le', le),))
+                    lines.append('%s_bucket%s %d' % (name, bucket_labels, total))
+                lines.append('%s_sum%s %f' % (name, format_labels(labels), hist.sum))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), hist.count))
+    return '\n'.join(lines) + '\n'
+
+def start_timer():
+    g.request_start = time.perf_counter()
+
+def record_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        # use the route pattern so paths with ids don't each get a
+        # histogram
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = {'route': rule, 'method': request.method,
+                  'status': response.status_code}
+        observe('http_request_duration_seconds', labels,
+                time.perf_counter() - start)
+    return response
+
+def metrics():
+    response = make_response(get_metrics_text())
+    response.mimetype = 'text/plain; version=0.0.4'
+    return response
+
+def init_app(app):
+    '''Time all of a flask app's requests and add the /metrics route'''
+    app.before_request(start_timer)
+    app.after_request(record_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -6,7 +6,8 @@ create table sites (id serial primary key, stid varchar unique, number smallint,
 
 create table available_times (id serial primary key, time timestamp unique not null, active bool);
 
-create table simulations (id serial primary key, site_id int references sites, time_id int references available_times on delete cascade not null, forward bool not null, metadata jsonb, unique(site_id, time_id, forward));
+-- progress is the fraction of the contours that have been added so far
+create table simulations (id serial primary key, site_id int references sites, time_id int references available_times on delete cascade not null, forward bool not null, metadata jsonb, progress real, unique(site_id, time_id, forward));
 
 -- scrapping this in favor of a table that uses height and time
 -- indices instead of raw values:
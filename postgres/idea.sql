@@ -7,14 +7,40 @@ create extension postgis;
 create extension multicorn;
 
 create schema idea;
-create table idea.simulations (id serial primary key, time_range tsrange, trajectories jsonb, high_resolution boolean, unique(time_range, high_resolution));
+-- trajectory_index holds each trajectory's bounding box and first/last
+-- point offsets, used to slice the trajectories without reading them all
+create table idea.simulations (id serial primary key, time_range tsrange, trajectories jsonb, trajectory_index jsonb, high_resolution boolean, unique(time_range, high_resolution));
+-- the same trajectories stored one per row, with the time (seconds
+-- since 1970) as the M coordinate, for indexed spatial/temporal queries
+create table idea.trajectories (simulation_id int references idea.simulations on delete cascade, traj int, path geometry(LineStringZM, 4326), aod float[], primary key(simulation_id, traj));
+create index on idea.trajectories using gist (path);
 
 create schema viirs;
 -- create table viirs.swaths (id serial primary key, time timestamp, cod raster, aod raster, high_resolution boolean, unique(time, high_resolution));
-create table viirs.swaths (id serial primary key, time timestamp, swath raster, high_resolution boolean, unique(time, high_resolution));
+-- envelope and footprint (a simplified outline of the non-missing
+-- pixels) are calculated during ingest, in the swaths' web mercator
+create table viirs.swaths (id serial primary key, time timestamp, swath raster, envelope geometry(Polygon, 3857), footprint geometry(MultiPolygon, 3857), high_resolution boolean, unique(time, high_resolution));
+-- (indexed with the fallback to the raster envelope used by /swaths,
+-- for swaths loaded before the envelope column existed)
+create index on viirs.swaths using gist (coalesce(envelope, ST_SetSRID(ST_Envelope(swath), 3857)));
 
 -- NWP model inputs
 create table idea.nwp (id serial primary key, time timestamp, nwp raster, high_resolution boolean, unique(time, high_resolution));
+-- 2x, 4x and 8x downsampled overviews of the swaths and NWP rasters,
+-- for rendering zoomed out maps
+create table viirs.o_2_swaths (id serial primary key, time timestamp, swath raster, high_resolution boolean, unique(time, high_resolution));
+create table viirs.o_4_swaths (id serial primary key, time timestamp, swath raster, high_resolution boolean, unique(time, high_resolution));
+create table viirs.o_8_swaths (id serial primary key, time timestamp, swath raster, high_resolution boolean, unique(time, high_resolution));
+create table idea.o_2_nwp (id serial primary key, time timestamp, nwp raster, high_resolution boolean, unique(time, high_resolution));
+create table idea.o_4_nwp (id serial primary key, time timestamp, nwp raster, high_resolution boolean, unique(time, high_resolution));
+create table idea.o_8_nwp (id serial primary key, time timestamp, nwp raster, high_resolution boolean, unique(time, high_resolution));
+-- wind directions (degrees clockwise from due south) for each NWP
+-- level followed by the wind speeds, calculated from the NWP winds
+create table idea.wind (id serial primary key, time timestamp, wind raster, high_resolution boolean, unique(time, high_resolution));
+
+-- scale factors for rasters stored as 16-bit integers (values are
+-- stored as round((value - add_offset) / scale_factor))
+create table idea.band_scales (variable varchar primary key, scale_factor float, add_offset float);
 
 
 -- some filesystem tables to make updating more convenient